@@ -18,6 +18,7 @@
 """Simple endpoint that returns an email or an attachment from one"""
 """ THIS ONLY DEALS WITH PUBLIC EMAILS FOR NOW - AAA IS BEING WORKED ON"""
 
+import plugins.conditional
 import plugins.server
 import plugins.session
 import plugins.messages
@@ -48,6 +49,10 @@ async def process(
     if email:
         # Are we fetching an attachment?
         if not indata.get("attachment"):
+            # Emails only change if edited, which is covered by the last edit time in the ETag
+            etag = plugins.conditional.make_etag(session, email["mid"], email.get("deleted", False))
+            if plugins.conditional.is_fresh(session, etag):
+                return plugins.conditional.not_modified(session)
             if not email.get("gravatar"):
                 email["gravatar"] = plugins.messages.gravatar(email)
             return email
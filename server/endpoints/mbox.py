@@ -17,6 +17,8 @@
 
 """Endpoint for returning emails in mbox format as a single archive"""
 import asyncio
+import plugins.admission
+import plugins.compression
 import plugins.server
 import plugins.session
 import plugins.messages
@@ -96,15 +98,17 @@ async def process(
     # Return mbox archive with filename as a stream
     response = aiohttp.web.StreamResponse(status=200, headers=headers)
     response.enable_chunked_encoding()
-    await response.prepare(request)
+    stream = plugins.compression.CompressedStream(server, request, response)
+    await stream.prepare()
 
+    failed = False
     async for emails in plugins.messages.query_batch(
         session,
         query_defuzzed,
         metadata_only=True,
         epoch_order="asc"
     ):
-        for email in emails:
+        for i, email in enumerate(emails):
             source = await plugins.messages.get_source(session, permalink=email.get("dbid"))
             mboxrd_source = convert_source(source)
             # Ensure each non-empty source ends with a blank line
@@ -112,12 +116,24 @@ async def process(
                 mboxrd_source += "\n"
             try:
                 async with server.streamlock:
-                    await asyncio.wait_for(response.write(mboxrd_source.encode("utf-8")), timeout=5)
+                    # Flush compressed output at the end of each batch, so the client keeps receiving data
+                    await asyncio.wait_for(
+                        stream.write(mboxrd_source.encode("utf-8"), flush=i == len(emails) - 1), timeout=5
+                    )
             except (TimeoutError, RuntimeError, CancelledError):
+                failed = True
                 break  # Writing stream failed, break it off.
+        if failed:
+            break
+    if not failed:
+        try:
+            async with server.streamlock:
+                await asyncio.wait_for(stream.finish(), timeout=5)
+        except (TimeoutError, RuntimeError, CancelledError):
+            pass
     return response
 
 
 def register(_server: plugins.server.BaseServer):
     # Note that this is a StreamingEndpoint!
-    return plugins.server.StreamingEndpoint(process)
+    return plugins.server.StreamingEndpoint(process, priority=plugins.admission.BULK)
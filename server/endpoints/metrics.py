@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Endpoint that returns the server's metrics in the Prometheus text format (admins only)"""
+
+import plugins.server
+import plugins.session
+import aiohttp.web
+
+
+async def process(
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, _indata: dict,
+) -> aiohttp.web.Response:
+    if not session.credentials or not session.credentials.admin:
+        return aiohttp.web.Response(headers={}, status=403, text="You need administrative access to view metrics.")
+    return aiohttp.web.Response(
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        status=200,
+        text=server.metrics.render(),
+    )
+
+
+def register(_server: plugins.server.BaseServer):
+    return plugins.server.Endpoint(process)
@@ -36,6 +36,22 @@ def user_error(msg):
 
 async def process(
     server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+) -> typing.Union[dict, aiohttp.web.Response]:
+    try:
+        return await process_action(server, session, indata)
+    finally:
+        # Anything but viewing the log may have changed emails, so invalidate conditional responses (ETags)
+        # and cached results. Each change is in the audit log, which is written with refresh='wait_for'.
+        is_admin = session.credentials and session.credentials.admin
+        if indata.get("action") != "log" and is_admin and session.database:
+            try:
+                server.data.edits = max(server.data.edits, await plugins.auditlog.count_edits(session.database))
+            except plugins.database.DBError as e:
+                print("Could not count edits: %s" % e)
+
+
+async def process_action(
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
 ) -> typing.Union[dict, aiohttp.web.Response]:
     action = indata.get("action")
     docs = indata.get("documents", [])
@@ -207,6 +223,8 @@ async def process(
                 # Convert List-ID after verification
                 new_lid = "<" + new_list.strip("<>").replace("@", ".") + ">"  # foo@bar.baz -> <foo.bar.baz>
                 if not new_lid == origin_lid:
+                    # The thread summaries are not updated; views of new_lid fall back to threading on request
+                    # until tools/build-thread-index.py is rerun for it. Edited subjects and dates are picked up.
                     email["list"] = new_lid
                     email["list_raw"] = new_lid
                     email["forum"] = new_forum
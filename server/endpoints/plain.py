@@ -21,6 +21,7 @@
    canonical link to the standard corresponding URLs, which should make 
    the indexed data available under the right URLs when searching."""
 
+import plugins.admission
 import plugins.server
 import plugins.session
 import plugins.messages
@@ -99,7 +100,7 @@ async def process(
                     query_limit=server.config.database.max_hits,
                 )
                 threads = plugins.messages.ThreadConstructor(results)
-                thread_struct, _authors = await server.runners.run(threads.construct)
+                thread_struct, _authors = await server.runners.run_cpu(threads.construct)
                 for (
                     thread
                 ) in (
@@ -169,4 +170,4 @@ async def process(
 
 
 def register(_server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    return plugins.server.Endpoint(process, priority=plugins.admission.CRAWLER)
@@ -21,6 +21,7 @@ import plugins.session
 import aiohttp.web
 import typing
 import fnmatch
+import time
 
 """ Generic preferences endpoint for Pony Mail codename Foal"""
 """ This is incomplete, but will work for anonymous tests. """
@@ -44,12 +45,13 @@ async def process(
     prefs: dict = {"login": {}}
     prefs['versions'] = versions
     lists: dict = {}
+    access = plugins.aaa.get_access(session)
     for ml, entry in server.data.lists.items():
         if "@" in ml:
             lname, ldomain = ml.split("@", 1)
             can_access = True
             if entry.get("private", True):
-                can_access = plugins.aaa.can_access_list(session, ml)
+                can_access = access.can_access_list(plugins.aaa.list_raw_of(ml))
             if server.config.ui.focus_domain != "*":
                 if '*' in server.config.ui.focus_domain:
                     if not fnmatch.fnmatch(ldomain, server.config.ui.focus_domain):
@@ -82,6 +84,9 @@ async def process(
         # If stored in memory, remove from there.
         if session.cookie in server.data.sessions:
             del server.data.sessions[session.cookie]
+        # Other workers may have it in memory too
+        if server.workers > 1:
+            server.data.logged_out[session.cookie] = time.time()
         session.credentials = None
         return aiohttp.web.Response(
             headers={
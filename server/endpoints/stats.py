@@ -17,19 +17,32 @@
 
 """Simple endpoint that returns the server's gathered activity data"""
 """ THIS ONLY DEALS WITH PUBLIC EMAILS FOR NOW - AAA IS BEING WORKED ON"""
+import plugins.compression
+import plugins.conditional
+import plugins.database
+import plugins.encoder
 import plugins.server
 import plugins.session
 import plugins.messages
 import plugins.defuzzer
 import plugins.offloader
+import plugins.profiler
+import asyncio
+import copy
 import email.utils
+import json
+import traceback
 import typing
 import aiohttp.web
+from asyncio.exceptions import CancelledError
 import time
 
 async def process(
-    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
-) -> typing.Union[dict, aiohttp.web.Response]:
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    indata: dict,
+) -> typing.Union[dict, aiohttp.web.Response, aiohttp.web.StreamResponse]:
 
     # must provide list and domain
     xlist = indata.get("list", None)
@@ -47,7 +60,8 @@ async def process(
     
     # get a filter for use with get_activity_span (no date)
     # It can also be used with dated queries
-    query_filter = await plugins.messages.get_accessible_filter(session, query_defuzzed_nodate)
+    with plugins.profiler.span(session.profiler, "accessible_filter"):
+        query_filter = await plugins.messages.get_accessible_filter(session, query_defuzzed_nodate)
     if query_filter:
         query_defuzzed['filter'] = query_filter
         query_defuzzed_nodate['filter'] = query_filter
@@ -67,6 +81,13 @@ async def process(
         if len(results) == 0:
             return {"changed" : False}
 
+    # Has anything changed since the client last fetched this view?
+    with plugins.profiler.span(session.profiler, "validator"):
+        hits, newest, hidden = await plugins.messages.get_validator(session, query_defuzzed)
+    etag = plugins.conditional.make_etag(session, plugins.conditional.query_hash(indata), hits, newest, hidden)
+    if plugins.conditional.is_fresh(session, etag):
+        return plugins.conditional.not_modified(session)
+
     # statsOnly: Whether to only send statistical info (for n-grams etc), and not the
     # thread struct and message bodies
     # Param: quick
@@ -75,44 +96,173 @@ async def process(
     # i.e. omit thread_struct, top 10 participants and word-cloud   
     emailsOnly = 'emailsOnly' in indata
 
+    # Sessions with the same access scope see the same results for the same query
+    cache = server.stats_cache
+    cache_key = (
+        plugins.conditional.access_scope(session),
+        json.dumps([query_defuzzed, query_defuzzed_nodate, statsOnly, emailsOnly], sort_keys=True),
+    )
+    validator = (hits, newest, hidden, server.data.edits)
+    # Large results are streamed as they are fetched, rather than built in memory
+    stream_hits = server.config.server.stream_stats_hits
+    streamed = bool(stream_hits and hits > stream_hits and not session.profiler)
+    entry = cache.get(cache_key) if cache.max_size else None
+    if entry:
+        if entry.validator == validator:
+            cache.hits += 1
+            if session.profiler:
+                session.profiler.root.data["stats_cache"] = "hit"
+            return cached_response(session, entry.value, indata)
+        # Only new emails may be served late. Hidden, deleted or edited ones must be gone at once.
+        # Streamed results are not refreshed in the background, as compute() would build them in memory.
+        if entry.validator[2:] == validator[2:] and not streamed and cache.can_serve_stale(entry):
+            # Serve the outdated result, without a validator so the client does not keep it, and refresh it
+            cache.stale_hits += 1
+            if session.profiler:
+                session.profiler.root.data["stats_cache"] = "stale"
+            session.response_headers.pop("ETag", None)
+            fields = list_fields(indata)
+            cache.refresh(
+                cache_key,
+                lambda: refresh(
+                    server, session, cache_key, validator, fields, query_defuzzed, query_defuzzed_nodate,
+                    statsOnly, emailsOnly,
+                ),
+            )
+            return cached_response(session, entry.value, indata)
+    cache.misses += 1
+
+    if streamed:
+        return await stream(
+            server, request, session, indata, query_defuzzed, query_defuzzed_nodate, statsOnly, emailsOnly,
+            cache_key, validator,
+        )
+
+    output = await compute(server, session, query_defuzzed, query_defuzzed_nodate, statsOnly, emailsOnly)
+    output.update(list_fields(indata))
+    if session.profiler:  # The profiler adds its timings to the output, so skip the cache
+        return personalise(output, indata)
+    members = await store(server, cache_key, validator, output)
+    return cached_response(session, members, indata)
+
+
+def list_fields(indata: dict) -> dict:
+    xlist = indata["list"]
+    xdomain = indata["domain"]
+    return {
+        "searchlist": f"<{xlist}.{xdomain}>",
+        "domain": xdomain,
+        "name": xlist,
+        "list": f"{xlist}@{xdomain}",
+    }
+
+
+def cached_response(
+    session: plugins.session.SessionObject, members: bytes, indata: dict
+) -> typing.Union[dict, aiohttp.web.Response]:
+    """Returns an encoded (cached) result, with the request specific fields added"""
+    if session.profiler:  # Decode it, so the profiler can add its timings
+        return personalise(json.loads(b"{" + members + b"}"), indata)
+    body = b"{" + members + b"," + plugins.encoder.encode_members(personalise({}, indata)) + b"}"
+    headers = dict(session.response_headers)
+    headers["Content-Type"] = "application/json"
+    return aiohttp.web.Response(headers=headers, status=200, body=body)
+
+
+def personalise(output: dict, indata: dict) -> dict:
+    """Adds the request specific fields to a (possibly shared) stats result"""
+    output = dict(output)
+    output["searchParams"] = indata
+    output["unixtime"] = int(time.time())
+    return output
+
+
+async def store(server: plugins.server.BaseServer, cache_key: tuple, validator: tuple, output: dict) -> bytes:
+    """
+    Encodes a stats result less its outer braces, as cached_response() serves it,
+    and stores that in the cache if it fits. Returns the encoding.
+    """
+    if plugins.encoder.estimated_size(output) > server.config.server.offload_json_size:
+        members = await server.runners.run_cpu(plugins.encoder.encode_members, output)
+    else:
+        members = plugins.encoder.encode_members(output)
+    server.stats_cache.put(cache_key, members, validator, len(members))
+    return members
+
+
+async def refresh(
+    server: plugins.server.BaseServer,
+    session: plugins.session.SessionObject,
+    cache_key: tuple,
+    validator: tuple,
+    fields: dict,
+    query_defuzzed: dict,
+    query_defuzzed_nodate: dict,
+    statsOnly: bool,
+    emailsOnly: bool,
+):
+    """Recomputes a cached stats result in the background, with its own database connection"""
+    xsession = copy.copy(session)
+    xsession.database = plugins.database.LazyDatabase(server.dbpool)
+    xsession.profiler = None
+    try:
+        output = await compute(server, xsession, query_defuzzed, query_defuzzed_nodate, statsOnly, emailsOnly)
+    finally:
+        xsession.database.release()
+    output.update(fields)
+    await store(server, cache_key, validator, output)
+
+
+async def compute(
+    server: plugins.server.BaseServer,
+    session: plugins.session.SessionObject,
+    query_defuzzed: dict,
+    query_defuzzed_nodate: dict,
+    statsOnly: bool,
+    emailsOnly: bool,
+) -> dict:
+    """Runs the queries and threading for a stats request"""
     source_fields = None
     if statsOnly:
         source_fields = ['epoch']
 
-    results = await plugins.messages.query(
-        session, query_defuzzed, query_limit=server.config.database.max_hits, source_fields=source_fields
-    )
+    threaded = not statsOnly and not emailsOnly
+    # Thread the emails page by page while the scroll runs, unless the thread summaries can be used instead
+    threads = None
+    if threaded and not server.config.database.thread_index:
+        threads = plugins.messages.ThreadConstructor()
 
-    wordcloud = None
-    if server.config.ui.wordcloud and not emailsOnly and not statsOnly:
-        wordcloud = await plugins.messages.wordcloud(session, query_defuzzed)
-    oldest, youngest, active_months = await plugins.messages.get_activity_span(session, query_defuzzed_nodate)
+    # Only the accessible filter had to come first, the rest of the queries can all run at once
+    results, wordcloud, (oldest, youngest, active_months) = await asyncio.gather(
+        fetch_results(server, session, query_defuzzed, source_fields, threads),
+        get_wordcloud(server, session, query_defuzzed, statsOnly, emailsOnly),
+        get_activity_span(session, query_defuzzed_nodate),
+    )
 
     authors = {}
     tstruct = {}
     top10_authors = None
-    if not statsOnly and not emailsOnly:
-        threads = plugins.messages.ThreadConstructor(results)
-        tstruct, authors = await server.runners.run(threads.construct)
-
-        # author entries are now [count, gravatar]
-        # as we cannot reconstruct the correct gravatar from an anonymised address
-        all_authors = sorted(authors.items(), key=lambda x: x[1][0], reverse=True)  # sort in reverse by author count
-        top10_authors = []
-        for author, data in all_authors[:10]:
-            name, address = email.utils.parseaddr(author)
-            top10_authors.append(
-                {"email": address, "name": name, "count": data[0], "gravatar": data[1]}
-            )
-
-    # Trim email data so as to reduce download sizes
-    for msg in results:
-        if statsOnly:
-            for header in list(msg.keys()):
-                if not header == 'epoch':
-                    del msg[header]
+    if threaded:
+        summarised = None
+        if server.config.database.thread_index:
+            with plugins.profiler.span(session.profiler, "thread_summaries", emails=len(results)):
+                summaries = await plugins.messages.get_thread_summaries(session, query_defuzzed, results)
+                if summaries is not None:
+                    summarised = await server.runners.run_cpu(
+                        plugins.messages.project_thread_summaries, summaries, results
+                    )
+        if summarised is not None:
+            tstruct, authors = summarised
+        elif threads:
+            tstruct, authors = threads.threads, threads.authors
         else:
-            plugins.messages.trim_email(msg, external=True)
+            threads = plugins.messages.ThreadConstructor(results)
+            with plugins.profiler.span(session.profiler, "thread_construction", emails=len(results)):
+                tstruct, authors = await server.runners.run_cpu(threads.construct)
+
+        top10_authors = top_authors(authors)
+
+    trim_results(results, statsOnly)
 
     output = {
         "firstYear": oldest.year,
@@ -125,12 +275,6 @@ async def process(
         "no_threads": len(tstruct),
         "emails": list(sorted(results, key=lambda x: x["epoch"])),
         "participants": top10_authors or {},
-        "searchlist": f"<{xlist}.{xdomain}>",
-        "domain": xdomain,
-        "name": xlist,
-        "list": f"{xlist}@{xdomain}",
-        "searchParams": indata,
-        "unixtime": int(time.time()),
     }
     if not statsOnly and not emailsOnly:
         output['thread_struct'] = tstruct
@@ -139,5 +283,224 @@ async def process(
     return output
 
 
+async def fetch_results(
+    server: plugins.server.BaseServer,
+    session: plugins.session.SessionObject,
+    query_defuzzed: dict,
+    source_fields: typing.Optional[typing.List[str]],
+    threads: typing.Optional[plugins.messages.ThreadConstructor],
+) -> typing.List[dict]:
+    """Fetches the emails of a stats request, threading them page by page if a thread constructor is given"""
+    query_limit = server.config.database.max_hits
+    results: typing.List[dict] = []
+    with plugins.profiler.span(session.profiler, "query"):
+        # Threading as the pages arrive needs them oldest first. A scroll sorted on epoch costs ES more than
+        # the unsorted (_doc order) one: each shard sorts its matches, and every page is a merge of the shards.
+        async for batch in plugins.messages.query_batch(
+            session, query_defuzzed, epoch_order="asc" if threads else "desc", source_fields=source_fields
+        ):
+            batch = batch[: query_limit + 1 - len(results)]  # Same cut-off as plugins.messages.query
+            results.extend(batch)
+            if threads:
+                with plugins.profiler.span(session.profiler, "thread_construction", emails=len(batch)):
+                    await server.runners.run(threads.add, batch)
+            if len(results) > query_limit:
+                break
+    return results
+
+
+async def get_wordcloud(
+    server: plugins.server.BaseServer,
+    session: plugins.session.SessionObject,
+    query_defuzzed: dict,
+    statsOnly: bool,
+    emailsOnly: bool,
+) -> typing.Optional[dict]:
+    if not server.config.ui.wordcloud or emailsOnly or statsOnly:
+        return None
+    with plugins.profiler.span(session.profiler, "wordcloud"):
+        return await plugins.messages.wordcloud(session, query_defuzzed)
+
+
+async def get_activity_span(session: plugins.session.SessionObject, query_defuzzed_nodate: dict):
+    with plugins.profiler.span(session.profiler, "activity_span"):
+        return await plugins.messages.get_activity_span(session, query_defuzzed_nodate)
+
+
+def top_authors(authors: dict) -> typing.List[dict]:
+    """Returns the ten most active participants"""
+    # author entries are now [count, gravatar]
+    # as we cannot reconstruct the correct gravatar from an anonymised address
+    all_authors = sorted(authors.items(), key=lambda x: x[1][0], reverse=True)  # sort in reverse by author count
+    top10_authors = []
+    for author, data in all_authors[:10]:
+        name, address = email.utils.parseaddr(author)
+        top10_authors.append(
+            {"email": address, "name": name, "count": data[0], "gravatar": data[1]}
+        )
+    return top10_authors
+
+
+def trim_results(results: typing.List[dict], statsOnly: bool):
+    """Trims email data so as to reduce download sizes"""
+    for msg in results:
+        if statsOnly:
+            for header in list(msg.keys()):
+                if not header == 'epoch':
+                    del msg[header]
+        else:
+            plugins.messages.trim_email(msg, external=True)
+
+
+async def stream(
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    indata: dict,
+    query_defuzzed: dict,
+    query_defuzzed_nodate: dict,
+    statsOnly: bool,
+    emailsOnly: bool,
+    cache_key: tuple,
+    validator: tuple,
+) -> aiohttp.web.StreamResponse:
+    """
+    Streams the same result as compute(), writing out each page of emails as it comes off the scroll.
+    The thread structure and participants follow the emails, once all of them have been seen.
+    The encoded result is cached if it fits, and then served by cached_response().
+    """
+    threads = None
+    if not statsOnly and not emailsOnly:
+        threads = plugins.messages.ThreadConstructor()
+    source_fields = ['epoch'] if statsOnly else None
+    # Fetch the first page while the word cloud and activity span queries run
+    pages = plugins.messages.query_batch(session, query_defuzzed, epoch_order="asc", source_fields=source_fields)
+    first_page = asyncio.ensure_future(pages.__anext__())
+    try:
+        wordcloud, (oldest, youngest, active_months) = await asyncio.gather(
+            get_wordcloud(server, session, query_defuzzed, statsOnly, emailsOnly),
+            get_activity_span(session, query_defuzzed_nodate),
+        )
+        head = {
+            "firstYear": oldest.year,
+            "lastYear": youngest.year,
+            "firstMonth": oldest.month,
+            "lastMonth": youngest.month,
+            "active_months": active_months,
+        }
+        head.update(list_fields(indata))
+
+        headers = dict(session.response_headers)
+        headers["Content-Type"] = "application/json"
+        response = aiohttp.web.StreamResponse(status=200, headers=headers)
+        response.enable_chunked_encoding()
+        compressed = plugins.compression.CompressedStream(server, request, response)
+        await compressed.prepare()
+        try:
+            members = await write_stream(
+                server, indata, compressed, all_pages(first_page, pages), threads, head, wordcloud, statsOnly
+            )
+        except Exception: # pylint: disable=broad-except
+            # Too late for an error response, the client already has a 200 and part of the result.
+            # Break off the connection, so it cannot mistake what it got for the whole result.
+            traceback.print_exc()
+            if request.transport:
+                request.transport.abort()
+            return response
+    finally:
+        first_page.cancel()  # In case we never got to it
+    if members is not None:
+        server.stats_cache.put(cache_key, members, validator, len(members))
+    return response
+
+
+async def all_pages(first_page: asyncio.Future, pages: typing.AsyncIterator[typing.List[dict]]):
+    """Yields the (prefetched) first page of a scroll, then the rest"""
+    try:
+        yield await first_page
+    except StopAsyncIteration:
+        return
+    async for page in pages:
+        yield page
+
+
+async def write_stream(
+    server: plugins.server.BaseServer,
+    indata: dict,
+    compressed: plugins.compression.CompressedStream,
+    pages: typing.AsyncIterator[typing.List[dict]],
+    threads: typing.Optional[plugins.messages.ThreadConstructor],
+    head: dict,
+    wordcloud: typing.Optional[dict],
+    statsOnly: bool,
+) -> typing.Optional[bytes]:
+    """
+    Writes a streamed stats result. Returns its encoding less the outer braces and the request specific
+    fields, for the cache, unless the stream was broken off or the result is too large to be cached.
+    """
+    cache_size = server.stats_cache.max_size
+    cached: typing.Optional[typing.List[bytes]] = [] if cache_size else None
+    cached_size = 0
+
+    async def write(data: bytes, flush: bool = True, cache: bool = True) -> bool:
+        nonlocal cached, cached_size
+        if cache and cached is not None:
+            cached.append(data)
+            cached_size += len(data)
+            if cached_size > cache_size:
+                cached = None  # Would never fit
+        try:
+            async with server.streamlock:
+                await asyncio.wait_for(compressed.write(data, flush=flush), timeout=5)
+            return True
+        except (TimeoutError, RuntimeError, CancelledError):
+            return False  # Writing stream failed, break it off.
+
+    if not await write(b"{" + plugins.encoder.encode_members(personalise({}, indata)) + b",", cache=False):
+        return None
+    if not await write(plugins.encoder.encode_members(head) + b',"emails":['):
+        return None
+
+    query_limit = server.config.database.max_hits
+    hits = 0
+    async for batch in pages:
+        batch = batch[: query_limit + 1 - hits]  # Same cut-off as plugins.messages.query
+        if threads:
+            await server.runners.run(threads.add, batch)
+        trim_results(batch, statsOnly)
+        if plugins.encoder.estimated_size(batch) > server.config.server.offload_json_size:
+            data = await server.runners.run_cpu(plugins.encoder.encode_members, batch)
+        else:
+            data = plugins.encoder.encode_members(batch)
+        if hits and data:
+            data = b"," + data
+        hits += len(batch)
+        if not await write(data):
+            return None
+        if hits > query_limit:
+            break
+
+    tail: typing.Dict[str, typing.Any] = {"hits": hits, "numparts": 0, "no_threads": 0, "participants": {}}
+    if threads:
+        tail["numparts"] = len(threads.authors)
+        tail["no_threads"] = len(threads.threads)
+        tail["participants"] = top_authors(threads.authors) or {}
+        tail["thread_struct"] = threads.threads
+    if wordcloud:
+        tail["cloud"] = wordcloud
+    tail_data = await plugins.encoder.encode_async(
+        server.runners, tail, offload_size=server.config.server.offload_json_size
+    )
+    if not await write(b"]," + tail_data[1:-1], flush=False) or not await write(b"}", flush=False, cache=False):
+        return None
+    try:
+        async with server.streamlock:
+            await asyncio.wait_for(compressed.finish(), timeout=5)
+    except (TimeoutError, RuntimeError, CancelledError):
+        return None
+    return b"".join(cached) if cached is not None else None
+
+
 def register(_server: plugins.server.BaseServer):
-    return plugins.server.Endpoint(process)
+    # Note that this is a StreamingEndpoint, so that large results can be streamed
+    return plugins.server.StreamingEndpoint(process)
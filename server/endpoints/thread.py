@@ -17,15 +17,18 @@
 
 """Simple endpoint that returns the server's gathered activity data"""
 
+import plugins.conditional
+import plugins.profiler
 import plugins.server
 import plugins.session
 import plugins.messages
+import aiohttp.web
 import typing
 
 
 async def process(
     _server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
-) -> typing.Optional[dict]:
+) -> typing.Union[None, dict, aiohttp.web.Response]:
     mailid = indata.get("id", "")
     listid = indata.get("listid", "")
 
@@ -38,11 +41,30 @@ async def process(
     if not email:
         return None
     if indata.get("find_parent"):
-        parent = await plugins.messages.find_parent(session, email)
+        with plugins.profiler.span(session.profiler, "find_parent"):
+            parent = await plugins.messages.find_parent(session, email)
         if parent:
             email = parent
     if email and isinstance(email, dict):
-        thread, emails, _pdocs = await plugins.messages.fetch_children(session, email, short=True)
+        # Has the thread changed since the client last fetched it?
+        with plugins.profiler.span(session.profiler, "validator"):
+            if email.get("thread"):
+                validator_query = {"must": [{"term": {"thread": email["thread"]}}]}
+            else:
+                validator_query = plugins.messages.thread_query(email["message-id"])
+            # Only count the replies the session can see, so the validator says nothing about the others
+            query_filter = await plugins.messages.get_accessible_filter(session, validator_query)
+            if query_filter:
+                validator_query["filter"] = query_filter
+            hits, newest, hidden = await plugins.messages.get_validator(session, validator_query)
+        newest = max(newest, email.get("epoch", 0))
+        etag = plugins.conditional.make_etag(
+            session, plugins.conditional.query_hash(indata), email["mid"], hits, newest, hidden
+        )
+        if plugins.conditional.is_fresh(session, etag):
+            return plugins.conditional.not_modified(session)
+        with plugins.profiler.span(session.profiler, "fetch_children"):
+            thread, emails, _pdocs = await plugins.messages.fetch_children(session, email, short=True)
     else:
         return None
 
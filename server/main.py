@@ -20,9 +20,12 @@
 import argparse
 import asyncio
 import importlib
-import json
 import os
+import shutil
+import signal
 import sys
+import tempfile
+import time
 import traceback
 import typing
 
@@ -30,13 +33,22 @@ import aiohttp.web
 import yaml
 import uuid
 
+import plugins.admission
 import plugins.background
+import plugins.cache
+import plugins.compression
 import plugins.configuration
 import plugins.database
+import plugins.encoder
 import plugins.formdata
+import plugins.metrics
 import plugins.offloader
+import plugins.privatefile
+import plugins.profiler
 import plugins.server
 import plugins.session
+import plugins.slowlog
+import plugins.snapshot
 
 PONYMAIL_FOAL_VERSION = "0.1.0"
 from server_version import PONYMAIL_SERVER_VERSION
@@ -65,17 +77,49 @@ class Server(plugins.server.BaseServer):
                         f"Could not find entry point 'register()' in {endpoint_file}, skipping!"
                     )
 
-    def __init__(self, args: argparse.Namespace):
+    def __init__(self, args: argparse.Namespace, workers: int = 1, worker_id: int = 0, shared_dir: str = ""):
         print(
             "==== Apache Pony Mail (Foal v/%s ~%s) starting... ====" % (PONYMAIL_FOAL_VERSION, PONYMAIL_SERVER_VERSION)
         )
         # Load configuration
         yml = yaml.safe_load(open(args.config))
         self.config = plugins.configuration.Configuration(yml)
-        self.data = plugins.configuration.InterData()
+        self.workers = workers
+        self.worker_id = worker_id
+        self.shared_dir = shared_dir
+        self.data = plugins.configuration.InterData(
+            max_sessions=self.config.cache.sessions,
+            session_max_age=plugins.session.FOAL_MAX_SESSION_AGE,
+            unknown_sessions_ttl=self.config.cache.unknown_sessions_ttl,
+        )
         self.handlers = dict()
-        self.dbpool = asyncio.Queue()
-        self.runners = plugins.offloader.ExecutorPool()
+        self.metrics = plugins.metrics.Metrics()
+        self.slowlog = None
+        if self.config.database.slow_query_log:
+            # Each worker gets its own log, as rotating a shared file is not process safe
+            self.slowlog = plugins.slowlog.SlowQueryLog(
+                self.config.database, suffix=f".{worker_id}" if workers > 1 else ""
+            )
+        self.dbpool = plugins.database.DatabasePool(self.config.database, self.metrics, self.slowlog)
+        self.admission = plugins.admission.AdmissionControl(self.config.admission)
+        self.runners = plugins.offloader.ExecutorPool(
+            threads=self.config.tasks.offload_threads, processes=self.config.tasks.offload_processes
+        )
+        self.stats_cache = plugins.cache.ResultCache(
+            max_size=self.config.cache.stats_size,
+            max_age=self.config.cache.stats_max_age,
+            stale_time=self.config.cache.stats_stale_time,
+        )
+        self.metrics.add_gauges(
+            "admission",
+            self.admission.stats,
+            counters=[f"{priority}_{kind}" for priority in plugins.admission.PRIORITIES for kind in ("admitted", "rejected")],
+        )
+        self.metrics.add_gauges("db_pool", self.dbpool.stats, counters=("checkouts", "wait_time"))
+        self.metrics.add_gauges("executor", self.runners.stats, counters=("completed", "failed", "wait_time"))
+        self.metrics.add_gauges("stats_cache", self.stats_cache.stats, counters=("hits", "stale_hits", "misses"))
+        self.metrics.add_gauges("sessions", self.data.sessions.stats, counters=("evictions", "expirations"))
+        self.metrics.add_gauges("unknown_sessions", self.data.unknown_sessions.stats, counters=("hits",))
         self.server = None
         self.streamlock = asyncio.Lock()
         self.api_logger = None
@@ -84,13 +128,6 @@ class Server(plugins.server.BaseServer):
         self.stoppable = False # allow remote stop for tests
         self.background_event = asyncio.Event() # for background task to wait on
 
-        # Make a pool of database connections for async queries
-        pool_size = self.config.database.pool_size
-        if pool_size < 1:
-            raise ValueError(f"pool_size {pool_size} must be > 0")
-        for _ in range(0, pool_size): # stop value is exclusive
-            self.dbpool.put_nowait(plugins.database.Database(self.config.database))
-
         # Load each URL endpoint
         if args.testendpoints:
             print("** Loading additional testing endpoints **")
@@ -164,82 +201,163 @@ class Server(plugins.server.BaseServer):
 
         # Find a handler, or 404
         if handler in self.handlers:
-            session = await plugins.session.get_session(self, request)
+            started = time.time()
+            # Wait for a slot in the concurrency budget of this endpoint, or turn the request away
+            priority = self.admission.classify(self.handlers[handler].priority, request)
+            if not await self.admission.acquire(handler, priority):
+                self.metrics.observe_request(handler, 503, time.time() - started)
+                headers["Retry-After"] = str(self.config.admission.retry_after)
+                return aiohttp.web.Response(
+                    headers=headers, status=503, text="Server is busy, please try again later.\n"
+                )
             try:
-                # Wait for endpoint response. This is typically JSON in case of success,
-                # but could be an exception (that needs a traceback) OR
-                # it could be a custom response, which we just pass along to the client.
-                xhandler = self.handlers[handler]
+                session = await plugins.session.get_session(self, request)
+                if session.database:
+                    session.database.endpoint = handler
+                # Admins can ask for a timing breakdown of the request, e.g. profile=true or profile=es,cprofile
+                profile_flag = indata.pop("profile", None)
+                if profile_flag and session.credentials and session.credentials.admin:
+                    session.profiler = plugins.profiler.from_flag(str(profile_flag))
+                    if session.database:
+                        session.database.profiler = session.profiler
+                response = await self.run_endpoint(handler, request, session, indata, headers)
+            finally:
+                self.admission.release(handler, priority)
+            self.metrics.observe_request(
+                handler,
+                response.status,
+                time.time() - started,
+                session.database.query_stats if session.database else None,
+            )
+            return response
+        else:
+            return aiohttp.web.Response(
+                headers=headers, status=404, text="API Endpoint not found!"
+            )
+
+    async def run_endpoint(
+        self,
+        handler: str,
+        request: aiohttp.web.BaseRequest,
+        session: plugins.session.SessionObject,
+        indata: dict,
+        headers: dict,
+    ) -> typing.Union[aiohttp.web.Response, aiohttp.web.StreamResponse]:
+        """Runs an endpoint and turns its output into a response"""
+        try:
+            # Wait for endpoint response. This is typically JSON in case of success,
+            # but could be an exception (that needs a traceback) OR
+            # it could be a custom response, which we just pass along to the client.
+            xhandler = self.handlers[handler]
+            if session.profiler:
+                await session.profiler.start()
+            with plugins.profiler.span(session.profiler, "endpoint", endpoint=handler):
                 if isinstance(xhandler, plugins.server.StreamingEndpoint):
                     output = await xhandler.exec(self, request, session, indata)
                 elif isinstance(xhandler, plugins.server.Endpoint):
                     output = await xhandler.exec(self, session, indata)
-                if session.database:
-                    self.dbpool.put_nowait(session.database)
-                    self.dbpool.task_done()
-                    session.database = None
-                if isinstance(output, aiohttp.web.Response) or isinstance(output, aiohttp.web.StreamResponse):
-                    return output
-                if output:
-                    jsout = await self.runners.run(json.dumps, output, indent=2)
-                    headers["content-type"] = "application/json"
-                    headers["Content-Length"] = str(len(jsout))
-                    return aiohttp.web.Response(headers=headers, status=200, text=jsout)
-                return aiohttp.web.Response(
-                    headers=headers, status=404, text="Content not found"
-                )
-            # If a handler hit an exception, we need to print that exception somewhere,
-            # either to the web client or stderr:
-            except Exception: # TODO: narrow exception
-                if session.database:
-                    self.dbpool.put_nowait(session.database)
-                    self.dbpool.task_done()
-                    session.database = None
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                err = "\n".join(
-                    traceback.format_exception(exc_type, exc_value, exc_traceback)
-                )
-                # By default, we print the traceback to the user, for easy debugging.
-                if self.config.ui.traceback:
-                    return aiohttp.web.Response(
-                        headers=headers, status=500, text="API error occurred: \n" + err
+            if session.database:
+                session.database.release()
+            if isinstance(output, aiohttp.web.Response) and not output.prepared:
+                await plugins.compression.compress_response(self, request, output)
+                return output
+            if isinstance(output, aiohttp.web.StreamResponse):
+                return output
+            if output:
+                with plugins.profiler.span(session.profiler, "serialization"):
+                    jsout = await plugins.encoder.encode_async(
+                        self.runners,
+                        output,
+                        pretty=self.config.server.pretty_json,
+                        offload_size=self.config.server.offload_json_size,
+                    )
+                if session.profiler and isinstance(output, dict):
+                    # Re-encode with the timing tree attached
+                    session.profiler.stop()
+                    jsout = plugins.encoder.encode(
+                        dict(output, _profile=session.profiler.to_dict()), pretty=self.config.server.pretty_json
                     )
-                # If client traceback is disabled, we print it to stderr instead, but leave an
-                # error ID for the client to report back to the admin. Every line of the traceback
-                # will have this error ID at the beginning of the line, for easy grepping.
-                # We only need a short ID here, let's pick 18 chars.
-                eid = str(uuid.uuid4())[:18]
-                sys.stderr.write("API Endpoint %s got into trouble (%s): \n" % (request.path, eid))
-                for line in err.split("\n"):
-                    sys.stderr.write("%s: %s\n" % (eid, line))
+                headers["content-type"] = "application/json"
+                headers.update(session.response_headers)
+                jsout = await plugins.compression.compress_body(self, request, headers, jsout)
+                headers["Content-Length"] = str(len(jsout))
+                return aiohttp.web.Response(headers=headers, status=200, body=jsout)
+            return aiohttp.web.Response(
+                headers=headers, status=404, text="Content not found"
+            )
+        # If a handler hit an exception, we need to print that exception somewhere,
+        # either to the web client or stderr:
+        except Exception: # TODO: narrow exception
+            if session.database:
+                session.database.release()
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            err = "\n".join(
+                traceback.format_exception(exc_type, exc_value, exc_traceback)
+            )
+            # By default, we print the traceback to the user, for easy debugging.
+            if self.config.ui.traceback:
                 return aiohttp.web.Response(
-                    headers=headers, status=500, text="API error occurred. The application journal will have "
-                                                      "information. Error ID: %s" % eid
+                    headers=headers, status=500, text="API error occurred: \n" + err
                 )
-        else:
+            # If client traceback is disabled, we print it to stderr instead, but leave an
+            # error ID for the client to report back to the admin. Every line of the traceback
+            # will have this error ID at the beginning of the line, for easy grepping.
+            # We only need a short ID here, let's pick 18 chars.
+            eid = str(uuid.uuid4())[:18]
+            sys.stderr.write("API Endpoint %s got into trouble (%s): \n" % (request.path, eid))
+            for line in err.split("\n"):
+                sys.stderr.write("%s: %s\n" % (eid, line))
             return aiohttp.web.Response(
-                headers=headers, status=404, text="API Endpoint not found!"
+                headers=headers, status=500, text="API error occurred. The application journal will have "
+                                                  "information. Error ID: %s" % eid
             )
+        finally:
+            if session.profiler:
+                session.profiler.stop()
+
+    @property
+    def snapshot_path(self) -> str:
+        """Each worker keeps its own snapshot, as they each have their own sessions"""
+        path = self.config.tasks.snapshot
+        if path and self.workers > 1:
+            path += f".{self.worker_id}"
+        return path
 
     async def server_loop(self):
+        # Serve the data of the last run while the background tasks gather fresh data
+        if self.snapshot_path:
+            plugins.snapshot.load(self, self.snapshot_path)
+            asyncio.ensure_future(plugins.snapshot.run_snapshots(self, self.snapshot_path))
+        asyncio.ensure_future(plugins.background.run_session_tasks(self))
         self.server = aiohttp.web.Server(self.handle_request)
         runner = aiohttp.web.ServerRunner(self.server)
         await runner.setup()
         site = aiohttp.web.TCPSite(
-            runner, self.config.server.ip, self.config.server.port
+            runner, self.config.server.ip, self.config.server.port, reuse_port=self.workers > 1
         )
         await site.start()
         print(
             "==== Serving up Pony goodness at %s:%s ===="
             % (self.config.server.ip, self.config.server.port)
         )
-        await plugins.background.run_tasks(self)
+        if self.workers > 1:
+            await plugins.background.run_shared_tasks(self)
+        else:
+            await plugins.background.run_tasks(self)
         await self.cleanup()
         await site.stop() # try to clean up
 
     async def cleanup(self):
-        while not self.dbpool.empty():
-            await self.dbpool.get_nowait().client.close()
+        await plugins.session.save_sessions(self)
+        if self.snapshot_path:
+            try:
+                plugins.snapshot.save_now(self, self.snapshot_path)
+            except OSError as e:
+                print("Could not save snapshot to %s: %s" % (self.snapshot_path, e))
+        await self.dbpool.close()
+        self.runners.shutdown()
+        if self.slowlog:
+            self.slowlog.close()
 
     def run(self):
         # get_event_loop is deprecated in 3.10, but the replacment new_event_loop
@@ -257,6 +375,58 @@ class Server(plugins.server.BaseServer):
         loop.close()
 
 
+def run_workers(args: argparse.Namespace, workers: int, shared_dir: str):
+    """Forks a number of server processes sharing the same port, and restarts any that crash"""
+    children: typing.Dict[int, int] = {}
+    # The workers trust what they share, so it must be kept where only we can write
+    if shared_dir:
+        try:
+            plugins.privatefile.check_owned(os.stat(shared_dir), shared_dir)
+        except OSError as e:
+            print("Cannot use %s to share data between workers: %s" % (shared_dir, e))
+            sys.exit(1)
+        own_dir = False
+    else:
+        shared_dir = tempfile.mkdtemp(prefix="ponymail-foal-")
+        own_dir = True
+
+    def spawn(worker_id: int):
+        pid = os.fork()
+        if pid == 0:  # Worker process
+            exit_code = 1
+            try:
+                Server(args, workers=workers, worker_id=worker_id, shared_dir=shared_dir).run()
+                exit_code = 0
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                # A forked worker must not run the supervisor's exit handlers or return to its loop
+                os._exit(exit_code) # pylint: disable=protected-access
+        children[pid] = worker_id
+
+    for worker_id in range(workers):
+        spawn(worker_id)
+    print(f"==== Started {workers} workers ====")
+    try:
+        while children:
+            pid, status = os.wait()
+            worker_id = children.pop(pid, -1)
+            if worker_id < 0 or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+                continue  # Not a worker, or worker was asked to stop
+            print(f"Worker {pid} exited unexpectedly (status {status}), restarting")
+            spawn(worker_id)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for pid in list(children):
+            os.waitpid(pid, 0)
+    if own_dir:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -291,5 +461,15 @@ if __name__ == "__main__":
         action='store_true',
         help="Enable test endpoints",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of server processes sharing the port (default: server.workers in the configuration, or 1)",
+    )
     cliargs = parser.parse_args()
-    Server(cliargs).run()
+    server_config = plugins.configuration.Configuration(yaml.safe_load(open(cliargs.config))).server
+    num_workers = cliargs.workers or server_config.workers
+    if num_workers > 1:
+        run_workers(cliargs, num_workers, server_config.shared_dir)
+    else:
+        Server(cliargs).run()
@@ -18,18 +18,43 @@
 """
 This is the AAA library for Pony Mail codename Foal
 It handles rights management for lists.
+The rules below are turned into an immutable access object per session (see get_access),
+so that checking thousands of emails costs a set lookup each, however expensive the rules.
 """
 
+import typing
+
 import plugins.session
 
 
-def can_access_email(session: plugins.session.SessionObject, email: dict) -> bool:
-    """Determine if an email can be accessed by the current user"""
-    # If public email, it can always be accessed
-    if not email.get("private", True): # Assume private if the flag is missing
+class Access(typing.NamedTuple):
+    """The access decision of a session: all lists, or public lists plus a set of private ones"""
+
+    allow_all: bool = False
+    lists: typing.FrozenSet[str] = frozenset()  # list_raw of the accessible private lists
+
+    def can_access_list(self, list_raw: typing.Optional[str]) -> bool:
+        return self.allow_all or list_raw in self.lists
+
+    def can_access_email(self, email: dict) -> bool:
+        # If public email, it can always be accessed
+        if not email.get("private", True): # Assume private if the flag is missing
+            return True
+        # If user can access the list, they can read the email
+        return self.can_access_list(email.get("list_raw", None))
+
+
+def list_raw_of(list_name: str) -> str:
+    """Turns a list name of the list directory (server.data.lists) back into its list_raw form"""
+    return "<%s>" % list_name.replace("@", ".", 1)
+
+
+def can_access_all(session: plugins.session.SessionObject) -> bool:
+    """Determine if the current user can access every list, including ones not yet in the list directory"""
+    # If logged in via a known oauth, we assume access for now...TO BE CHANGED
+    if session.credentials and session.credentials.authoritative:
         return True
-    # If user can access the list, they can read the email
-    return can_access_list(session, email.get("list_raw", None))
+    return False
 
 def can_access_list(session: plugins.session.SessionObject, _listid: str) -> bool:
     """Determine if a list can be accessed by the current user"""
@@ -37,3 +62,36 @@ def can_access_list(session: plugins.session.SessionObject, _listid: str) -> boo
     if session.credentials and session.credentials.authoritative:
         return True
     return False
+
+
+def get_access(session: plugins.session.SessionObject) -> Access:
+    """
+    Returns the access decision of a session. It is worked out once per session, and again only
+    when the background tasks refresh the list directory, unless the session can access all lists.
+    Private lists not yet in the directory are denied until the next refresh.
+    """
+    memo = session.access_memo  # Shared by the per-request copies of a cached session
+    lists = session.server.data.lists
+    access = memo.get("access")
+    if access is None or (not access.allow_all and memo.get("lists") is not lists):
+        if not session.credentials:
+            access = Access()
+        elif can_access_all(session):
+            access = Access(allow_all=True)
+        else:
+            access = Access(
+                lists=frozenset(
+                    list_raw_of(list_name)
+                    for list_name, entry in lists.items()
+                    if (entry.get("private", True) or entry.get("mixed"))
+                    and can_access_list(session, list_raw_of(list_name))
+                )
+            )
+        memo["access"] = access
+        memo["lists"] = lists
+    return access
+
+
+def can_access_email(session: plugins.session.SessionObject, email: dict) -> bool:
+    """Determine if an email can be accessed by the current user"""
+    return get_access(session).can_access_email(email)
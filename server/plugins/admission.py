@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the admission control library for Pony Mail codename Foal.
+Every endpoint has a concurrency budget per priority class (interactive,
+bulk export, crawler). Requests over budget wait for a bounded time, and are
+then turned away, so that a single bulk download or a crawler cannot starve
+normal browsing of database connections and offloader threads.
+"""
+
+import asyncio
+import collections
+import re
+import typing
+
+import aiohttp.web
+
+import plugins.configuration
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+CRAWLER = "crawler"
+PRIORITIES = (INTERACTIVE, BULK, CRAWLER)  # Highest priority first
+
+
+class Budget:
+    """Concurrency budget of a single endpoint and priority class, with a FIFO wait queue"""
+
+    def __init__(self, limit: int):
+        self.limit = limit  # 0 means unlimited
+        self.active = 0
+        self.waiters: typing.Deque[asyncio.Future] = collections.deque()
+
+    async def acquire(self, timeout: float) -> bool:
+        """Takes a slot, waiting at most timeout seconds for one. Returns False if none became available."""
+        if not self.limit or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            return True
+        if timeout <= 0:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as we timed out
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def release(self) -> None:
+        """Gives a slot back, handing it straight over to the oldest waiter if there is one"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+
+class AdmissionControl:
+    """Admission control for all endpoints of a server process"""
+
+    def __init__(self, config: plugins.configuration.AdmissionConfig):
+        self.config = config
+        self.crawler_agents = re.compile(config.crawler_agents, re.IGNORECASE) if config.crawler_agents else None
+        self.budgets: typing.Dict[typing.Tuple[str, str], Budget] = {}
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.rejected = {priority: 0 for priority in PRIORITIES}
+
+    def classify(self, endpoint_priority: str, request: aiohttp.web.BaseRequest) -> str:
+        """Returns the priority class of a request: that of its endpoint, lowered to crawler for known robots"""
+        if self.crawler_agents and self.crawler_agents.search(request.headers.get("User-Agent", "")):
+            return CRAWLER
+        return endpoint_priority
+
+    def _budget(self, endpoint: str, priority: str) -> Budget:
+        budget = self.budgets.get((endpoint, priority))
+        if budget is None:
+            budget = Budget(self.config.limits[priority])
+            self.budgets[(endpoint, priority)] = budget
+        return budget
+
+    async def acquire(self, endpoint: str, priority: str) -> bool:
+        """Admits a request, waiting for a slot if needed. Returns False if the request should be turned away."""
+        if not self.config.enabled:
+            return True
+        if await self._budget(endpoint, priority).acquire(self.config.max_wait[priority]):
+            self.admitted[priority] += 1
+            return True
+        self.rejected[priority] += 1
+        return False
+
+    def release(self, endpoint: str, priority: str) -> None:
+        if self.config.enabled:
+            self._budget(endpoint, priority).release()
+
+    def stats(self) -> dict:
+        stats = {}
+        for priority in PRIORITIES:
+            budgets = [budget for (_endpoint, xpriority), budget in self.budgets.items() if xpriority == priority]
+            stats[f"{priority}_active"] = sum(budget.active for budget in budgets)
+            stats[f"{priority}_waiting"] = sum(len(budget.waiters) for budget in budgets)
+            stats[f"{priority}_admitted"] = self.admitted[priority]
+            stats[f"{priority}_rejected"] = self.rejected[priority]
+        return stats
@@ -24,6 +24,8 @@ import plugins.session
 import typing
 import time
 
+EDIT_ACTIONS = ("edit", "delete", "hide", "unhide", "delatt")  # Audit log actions that change the archives
+
 
 class AuditLogEntry:
     _keys: tuple = (
@@ -92,3 +94,14 @@ async def add_entry(session: plugins.session.SessionObject, action: str, target:
         },
         refresh='wait_for',
     )
+
+
+async def count_edits(database) -> int:
+    """ Returns the number of changes made to the archives via the management console """
+    res = await database.search(
+        index=database.dbs.db_auditlog,
+        size=0,
+        track_total_hits=True,
+        body={"query": {"bool": {"must": [{"terms": {"action": list(EDIT_ACTIONS)}}]}}},
+    )
+    return res["hits"]["total"]["value"]
@@ -19,19 +19,29 @@
 
 import asyncio
 import datetime
+import json
+import os
 import re
 import sys
 import time
+import typing
 
 from elasticsearch_dsl import Search
 from elasticsearch import VERSION as ES_VERSION
 
+import plugins.auditlog
 import plugins.configuration
+import plugins.privatefile
 import plugins.server
 import plugins.database
+import plugins.session
 
 PYPONY_RE_PREFIX = re.compile(r"^([a-zA-Z]+:\s*)+")
 ACTIVITY_TIMESPAN = "now-90d"  # How far back to look for "current" activity in lists
+SHARED_DATA_POLL_INTERVAL = 5  # How often workers check for updated background data, in seconds
+SHARED_STATE_POLL_INTERVAL = 2  # How often workers publish and pick up edits and logouts, in seconds
+LOGOUT_MEMORY = 600  # How long a worker publishes a logout for, in seconds
+SESSION_TASKS_INTERVAL = 60  # How often expired sessions are dropped and session updates saved, in seconds
 
 
 class ProgTimer:
@@ -95,6 +105,7 @@ async def get_lists(database: plugins.configuration.DBConfig) -> dict:
         lists[list_name] = {
             "count": 0,   # We'll sort this later
             "private": False,
+            "mixed": list_name in lists,  # Public list with some private emails
         }
 
     # Get 90 day activity, if any
@@ -208,6 +219,15 @@ async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
 
     return activity
 
+async def get_edit_count(database: plugins.configuration.DBConfig) -> int:
+    """Counts the changes made via the management console, in the audit log"""
+    db = plugins.database.Database(database)
+    try:
+        return await plugins.auditlog.count_edits(db)
+    finally:
+        await db.client.close()
+
+
 async def get_data(server: plugins.server.BaseServer):
     """
     Fetches the data once.
@@ -219,6 +239,14 @@ async def get_data(server: plugins.server.BaseServer):
             print(f"Found {len(server.data.lists)} lists")
         except plugins.database.DBError as e:
             print("Could not fetch lists - database down or not connected: %s" % e)
+    async with ProgTimer("Counting management edits"):
+        try:
+            # Edits are only ever added, so never go back to an older count (e.g. one from before a restart)
+            server.data.edits = max(server.data.edits, await get_edit_count(server.config.database))
+        except plugins.database.DBNotFound:
+            pass  # No audit log, so no edits yet
+        except plugins.database.DBError as e:
+            print("Could not count edits - database down or not connected: %s" % e)
     async with ProgTimer("Gathering bi-weekly activity stats"):
         try:
             server.data.activity = await get_public_activity(server.config.database)
@@ -228,12 +256,35 @@ async def get_data(server: plugins.server.BaseServer):
                 % e
             )
 
-async def run_tasks(server: plugins.server.BaseServer) -> None:
+def publish_data(server: plugins.server.BaseServer, path: str) -> None:
+    """Writes the gathered background data to a file, for other workers to pick up"""
+    snapshot = {
+        "lists": server.data.lists,
+        "activity": server.data.activity,
+        "edits": server.data.edits,
+        "library_version": server.library_version,
+        "engine_version": server.engine_version,
+    }
+    plugins.privatefile.write(path, json.dumps(snapshot).encode("utf-8"))  # Atomic, so readers never see a partial file
+
+
+def load_data(server: plugins.server.BaseServer, path: str) -> None:
+    """Loads background data published by another worker"""
+    snapshot = json.loads(plugins.privatefile.read(path))
+    server.data.lists = snapshot["lists"]
+    server.data.activity = snapshot["activity"]
+    server.data.edits = max(server.data.edits, snapshot["edits"])
+    server.library_version = snapshot["library_version"]
+    server.engine_version = snapshot["engine_version"]
+
+
+async def run_tasks(server: plugins.server.BaseServer, publish_path: typing.Optional[str] = None) -> None:
     """
         Runs long-lived background data gathering tasks such as gathering statistics about email activity and the list
         of archived mailing lists, for populating the pony mail main index.
 
         Generally runs every 2½ minutes, or whatever is set in tasks/refresh_rate in ponymail.yaml
+        If publish_path is set, the data is also written there for other workers after each run.
     """
 
     # Initial setup
@@ -244,8 +295,122 @@ async def run_tasks(server: plugins.server.BaseServer) -> None:
 
     while True:
         await get_data(server)
+        if publish_path:
+            try:
+                publish_data(server, publish_path)
+            except OSError as e:
+                print("Could not publish background data to %s: %s" % (publish_path, e))
         try:
             await asyncio.wait_for(server.background_event.wait(), timeout=server.config.tasks.refresh_rate)
             break # if the event is set, then we have been asked to stop
         except asyncio.TimeoutError:
             pass # This is normal
+
+
+async def run_shared_tasks(server: plugins.server.BaseServer) -> None:
+    """
+        Runs the background tasks when there are several worker processes.
+        Whichever worker holds the lock on the shared data file gathers the data and publishes it,
+        the others load the published data whenever it changes. If the gathering worker exits,
+        its lock is released and another worker takes over.
+    """
+    import fcntl  # Not available on all platforms, but neither is forking workers
+
+    path = os.path.join(server.shared_dir, "data.json")
+    asyncio.ensure_future(run_shared_state(server))
+    last_loaded = 0.0
+    lock_fd = os.open(
+        os.path.join(server.shared_dir, "data.lock"), os.O_RDWR | os.O_CREAT | plugins.privatefile.O_NOFOLLOW, 0o600
+    )
+    with os.fdopen(lock_fd, "w") as lockfile:
+        while True:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pass  # Another worker is gathering data
+            else:
+                print("Worker %u is now gathering background data for all workers" % os.getpid())
+                await run_tasks(server, publish_path=path)
+                return
+            try:
+                mtime = os.stat(path).st_mtime
+                if mtime != last_loaded:
+                    load_data(server, path)
+                    last_loaded = mtime
+            except (OSError, ValueError, KeyError):
+                pass  # Not published (completely) yet
+            try:
+                await asyncio.wait_for(server.background_event.wait(), timeout=SHARED_DATA_POLL_INTERVAL)
+                break # if the event is set, then we have been asked to stop
+            except asyncio.TimeoutError:
+                pass # This is normal
+
+
+def publish_state(server: plugins.server.BaseServer, path: str) -> None:
+    """Writes the edit count and recent logouts of this worker to a file, for the other workers to pick up"""
+    now = time.time()
+    for session_id, logged_out in list(server.data.logged_out.items()):
+        if (now - logged_out) > LOGOUT_MEMORY:
+            del server.data.logged_out[session_id]
+    state = {"edits": server.data.edits, "logged_out": server.data.logged_out}
+    plugins.privatefile.write(path, json.dumps(state).encode("utf-8"))
+
+
+def load_state(server: plugins.server.BaseServer, path: str) -> None:
+    """Applies the edits and logouts published by another worker"""
+    state = json.loads(plugins.privatefile.read(path))
+    # Edits made elsewhere invalidate our ETags and cached results too
+    server.data.edits = max(server.data.edits, state["edits"])
+    for session_id in state["logged_out"]:
+        if session_id in server.data.sessions:
+            del server.data.sessions[session_id]
+
+
+async def run_shared_state(server: plugins.server.BaseServer) -> None:
+    """
+        Keeps the state that must agree between workers in sync, until the server is asked to stop.
+        Each worker publishes its edit count and recent logouts to a file of its own whenever they
+        change, and applies those of the other workers whenever their files change.
+    """
+    own_path = os.path.join(server.shared_dir, f"state.{server.worker_id}.json")
+    published = None
+    last_loaded: typing.Dict[str, float] = {}
+    while True:
+        current = (server.data.edits, set(server.data.logged_out))
+        if current != published:
+            try:
+                publish_state(server, own_path)
+                published = current
+            except OSError as e:
+                print("Could not publish worker state to %s: %s" % (own_path, e))
+        for worker_id in range(server.workers):
+            if worker_id == server.worker_id:
+                continue
+            path = os.path.join(server.shared_dir, f"state.{worker_id}.json")
+            try:
+                mtime = os.stat(path).st_mtime
+                if mtime != last_loaded.get(path):
+                    load_state(server, path)
+                    last_loaded[path] = mtime
+            except (OSError, ValueError, KeyError):
+                pass  # Not published (completely) yet
+        try:
+            await asyncio.wait_for(server.background_event.wait(), timeout=SHARED_STATE_POLL_INTERVAL)
+            break # if the event is set, then we have been asked to stop
+        except asyncio.TimeoutError:
+            pass # This is normal
+
+
+async def run_session_tasks(server: plugins.server.BaseServer) -> None:
+    """
+        Drops expired sessions from memory and saves the pending last access times of sessions
+        in one go, every minute or so, until the server is asked to stop.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(server.background_event.wait(), timeout=SESSION_TASKS_INTERVAL)
+            break # if the event is set, then we have been asked to stop
+        except asyncio.TimeoutError:
+            pass # This is normal
+        server.data.sessions.sweep(time.time())
+        await plugins.session.save_sessions(server)
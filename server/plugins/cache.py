@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the cache library for Pony Mail codename Foal.
+It keeps a size-capped LRU cache of computed results, each tagged with the
+validator that was current when it was computed, a size-capped LRU cache
+of user sessions that expire when not used for a while, and a short-lived
+negative cache of keys known not to exist.
+"""
+
+import asyncio
+import collections
+import time
+import typing
+
+
+class CacheEntry:
+    value: typing.Any
+    validator: typing.Any
+    size: int
+    created: float
+
+    def __init__(self, value: typing.Any, validator: typing.Any, size: int):
+        self.value = value
+        self.validator = validator
+        self.size = size
+        self.created = time.time()
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.created
+
+
+class ResultCache:
+    """Size-capped LRU cache with optional background refreshing of stale entries"""
+
+    def __init__(self, max_size: int, max_age: int, stale_time: int):
+        self.max_size = max_size  # Total (approximate) size of cached values, in bytes
+        self.max_age = max_age  # Entries older than this are never used
+        self.stale_time = stale_time  # Outdated entries younger than this may be served while refreshing
+        self.size = 0
+        self.entries: "collections.OrderedDict[typing.Hashable, CacheEntry]" = collections.OrderedDict()
+        self.refreshing: typing.Set[typing.Hashable] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key: typing.Hashable) -> typing.Optional[CacheEntry]:
+        """Returns the entry for a key, if present and not expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.age > self.max_age:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: typing.Hashable, value: typing.Any, validator: typing.Any, size: int) -> None:
+        """Adds or replaces an entry, evicting the least recently used entries if over capacity"""
+        self.remove(key)
+        if size > self.max_size:
+            return  # Too large to ever fit
+        self.entries[key] = CacheEntry(value, validator, size)
+        self.size += size
+        while self.size > self.max_size:
+            _key, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def remove(self, key: typing.Hashable) -> None:
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry.size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def can_serve_stale(self, entry: CacheEntry) -> bool:
+        return entry.age < self.stale_time
+
+    def refresh(self, key: typing.Hashable, refresher: typing.Callable[[], typing.Awaitable]) -> None:
+        """Runs a refresh of an entry in the background, unless one is already running for that key"""
+        if key in self.refreshing:
+            return
+        self.refreshing.add(key)
+
+        async def run_refresh():
+            try:
+                await refresher()
+            except Exception as e:  # Stale entry will be recomputed by the next request instead
+                print("Background refresh of cache entry failed: %s" % e)
+            finally:
+                self.refreshing.discard(key)
+
+        asyncio.ensure_future(run_refresh())
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
+
+
+class NegativeCache:
+    """Size-capped set of keys known not to exist, each remembered for ttl seconds"""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "collections.OrderedDict[typing.Hashable, float]" = collections.OrderedDict()
+        self.hits = 0
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        expires = self.entries.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            del self.entries[key]
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, key: typing.Hashable) -> None:
+        if not self.ttl:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = time.time() + self.ttl
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, key: typing.Hashable) -> None:
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+        }
+
+
+class SessionCache:
+    """
+    Size-capped LRU cache of session objects, keyed by session ID.
+    Sessions not accessed for max_age seconds are dropped on lookup, or by sweep().
+    Also keeps track of sessions whose last access time still needs to be saved,
+    including those evicted before it was.
+    """
+
+    def __init__(self, max_entries: int, max_age: int):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries: "collections.OrderedDict[str, typing.Any]" = collections.OrderedDict()
+        self.dirty: typing.Set[str] = set()  # Session IDs with unsaved last access times
+        self.evicted_dirty: typing.Dict[str, typing.Any] = {}  # Evicted sessions with unsaved last access times
+        self.hydrating: typing.Dict[str, asyncio.Future] = {}  # Lookups in progress of sessions not in memory
+        self.evictions = 0
+        self.expirations = 0
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self.entries
+
+    def __getitem__(self, session_id: str) -> typing.Any:
+        return self.entries[session_id]
+
+    def __setitem__(self, session_id: str, session: typing.Any) -> None:
+        self.entries[session_id] = session
+        self.entries.move_to_end(session_id)
+        while len(self.entries) > self.max_entries:
+            evicted_id, evicted = self.entries.popitem(last=False)
+            if evicted_id in self.dirty:
+                self.dirty.discard(evicted_id)
+                self.evicted_dirty[evicted_id] = evicted
+            self.evictions += 1
+
+    def __delitem__(self, session_id: str) -> None:
+        del self.entries[session_id]
+        self.dirty.discard(session_id)
+        self.evicted_dirty.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def items(self) -> typing.ItemsView[str, typing.Any]:
+        return self.entries.items()
+
+    def lookup(self, session_id: str, now: float) -> typing.Optional[typing.Any]:
+        """Returns a session if present and not expired, marking it as recently used"""
+        session = self.entries.get(session_id)
+        if session is None:
+            return None
+        if (now - session.last_accessed) > self.max_age:
+            del self[session_id]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(session_id)
+        return session
+
+    def touch(self, session_id: str, now: int) -> None:
+        """Updates the last access time of a session, to be saved by the next flush"""
+        session = self.entries.get(session_id)
+        if session is not None:
+            session.last_accessed = now
+            self.dirty.add(session_id)
+
+    def take_dirty(self) -> typing.List[typing.Any]:
+        """Returns the sessions with unsaved last access times, and clears the list"""
+        sessions = dict(self.evicted_dirty)
+        sessions.update((session_id, self.entries[session_id]) for session_id in self.dirty if session_id in self.entries)
+        self.dirty.clear()
+        self.evicted_dirty.clear()
+        return list(sessions.values())
+
+    def requeue(self, sessions: typing.Iterable[typing.Any]) -> None:
+        """Marks sessions taken by take_dirty() as unsaved again, e.g. after a failed save"""
+        for session in sessions:
+            if session is None:
+                continue
+            cookie = session.cookie
+            if self.entries.get(cookie) is session:
+                self.dirty.add(cookie)
+            elif cookie not in self.dirty:
+                self.evicted_dirty.setdefault(cookie, session)
+
+    def sweep(self, now: float) -> int:
+        """Drops all expired sessions, returning how many were dropped"""
+        expired = [
+            session_id for session_id, session in self.entries.items() if (now - session.last_accessed) > self.max_age
+        ]
+        for session_id in expired:
+            del self[session_id]
+        self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "unsaved": len(self.dirty) + len(self.evicted_dirty),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
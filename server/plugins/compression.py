@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the response compression library for Pony Mail codename Foal.
+It negotiates gzip or brotli (if installed) with the client, and compresses
+either whole response bodies or streams of data.
+"""
+
+import typing
+import zlib
+
+import aiohttp.web
+
+import plugins.server
+
+try:
+    import brotli  # Optional, better compression ratio than gzip
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Higher levels cost far more CPU for very little gain on text
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/mbox")
+
+
+def negotiate(accept_encoding: str) -> typing.Optional[str]:
+    """Picks the preferred encoding we support from an Accept-Encoding header, or None"""
+    accepted: typing.Dict[str, float] = {}
+    for entry in accept_encoding.lower().split(","):
+        coding, _, params = entry.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip()] = quality
+    wildcard = accepted.get("*", 0.0)
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and not brotli:
+            continue
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+class StreamCompressor:
+    """Incremental compressor for a single response"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            # wbits=31 produces a gzip header and trailer
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def flush(self, finish: bool = False) -> bytes:
+        """Flushes pending output. If finish is set, the stream is terminated."""
+        if self.encoding == "br":
+            return self.compressor.finish() if finish else self.compressor.flush()
+        return self.compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compresses a complete body in one go"""
+    compressor = StreamCompressor(encoding)
+    return compressor.compress(data) + compressor.flush(finish=True)
+
+
+def compressible(content_type: str) -> bool:
+    return content_type.lower().startswith(COMPRESSIBLE_TYPES)
+
+
+async def compress_body(
+    server: plugins.server.BaseServer, request: aiohttp.web.BaseRequest, headers: typing.MutableMapping, body: bytes
+) -> bytes:
+    """Compresses a response body if the client accepts it and it is large enough to be worth it.
+    Sets Content-Encoding and Vary in headers accordingly; the caller must set Content-Length afterwards."""
+    config = server.config.server
+    if not config.compression or len(body) < config.compression_min_size:
+        return body
+    headers["Vary"] = "Accept-Encoding"
+    encoding = negotiate(request.headers.get("Accept-Encoding", ""))
+    if not encoding:
+        return body
+    if len(body) > config.offload_compression_size:
+        body = await server.runners.run_cpu(compress, body, encoding)
+    else:
+        body = compress(body, encoding)
+    headers["Content-Encoding"] = encoding
+    return body
+
+
+async def compress_response(
+    server: plugins.server.BaseServer, request: aiohttp.web.BaseRequest, response: aiohttp.web.Response
+) -> None:
+    """Compresses the body of a (not yet prepared) response from an endpoint, if suitable"""
+    body = response.body
+    if (
+        not isinstance(body, bytes)
+        or "Content-Encoding" in response.headers
+        or not compressible(response.headers.get("Content-Type", response.content_type))
+    ):
+        return
+    new_body = await compress_body(server, request, response.headers, body)
+    if new_body is not body:
+        response.body = new_body
+        response.headers["Content-Length"] = str(len(new_body))
+
+
+class CompressedStream:
+    """Wraps a StreamResponse, compressing data on the fly if the client supports it.
+    Must be set up before the response is prepared."""
+
+    def __init__(
+        self,
+        server: plugins.server.BaseServer,
+        request: aiohttp.web.BaseRequest,
+        response: aiohttp.web.StreamResponse,
+    ):
+        self.request = request
+        self.response = response
+        self.compressor: typing.Optional[StreamCompressor] = None
+        if server.config.server.compression:
+            response.headers["Vary"] = "Accept-Encoding"
+            encoding = negotiate(request.headers.get("Accept-Encoding", ""))
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+                self.compressor = StreamCompressor(encoding)
+
+    async def prepare(self):
+        await self.response.prepare(self.request)
+
+    async def write(self, data: bytes, flush: bool = False):
+        """Writes a chunk of data. If flush is set, everything written so far is sent to the client."""
+        if self.compressor:
+            data = self.compressor.compress(data)
+            if flush:
+                data += self.compressor.flush()
+        if data:
+            await self.response.write(data)
+
+    async def finish(self):
+        """Writes any remaining compressed data. The stream must not be written to afterwards."""
+        if self.compressor:
+            tail = self.compressor.flush(finish=True)
+            self.compressor = None
+            if tail:
+                await self.response.write(tail)
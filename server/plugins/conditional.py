@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the conditional response library for Pony Mail codename Foal.
+Endpoints compute a cheap validator (ETag) for their response, and can skip
+all the heavy lifting if the client already has an up to date copy.
+Last-Modified is not used: edits, hidden emails and the access scope of the
+client change a response without changing the dates of the emails in it.
+"""
+
+import hashlib
+import json
+import typing
+
+import aiohttp.web
+
+import plugins.session
+
+
+def access_scope(session: plugins.session.SessionObject) -> str:
+    """Returns the access scope of a session. Sessions with the same scope see the same data."""
+    if not session.credentials:
+        return "anonymous"
+    if session.credentials.admin:
+        return "admin"
+    if session.credentials.authoritative:
+        return "authoritative"
+    return "user"
+
+
+def query_hash(indata: dict) -> str:
+    """Returns a stable hash of the request parameters"""
+    return hashlib.sha1(json.dumps(indata, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def make_etag(session: plugins.session.SessionObject, *parts: typing.Any) -> str:
+    """Creates a weak ETag from the validator parts, the access scope and the number of edits made"""
+    digest = hashlib.sha1(
+        json.dumps([access_scope(session), session.server.data.edits, *parts], default=str).encode("utf-8")
+    ).hexdigest()
+    # Weak, as the response may be sent with different content encodings
+    return f'W/"{digest[:32]}"'
+
+
+def is_fresh(session: plugins.session.SessionObject, etag: str) -> bool:
+    """Sets the validators for the response, and returns True if the client's copy is up to date"""
+    session.response_headers["ETag"] = etag
+    session.response_headers["Cache-Control"] = "private, no-cache"
+
+    if session.if_none_match:
+        if session.if_none_match.strip() == "*":
+            return True
+        # Weak comparison, ignore the W/ prefix
+        tags = [tag.strip().replace("W/", "", 1) for tag in session.if_none_match.split(",")]
+        return etag.replace("W/", "", 1) in tags
+    return False
+
+
+def not_modified(session: plugins.session.SessionObject) -> aiohttp.web.Response:
+    """Returns a 304 response carrying the validators"""
+    return aiohttp.web.Response(headers=session.response_headers, status=304)
@@ -17,20 +17,66 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import typing
+
+import plugins.cache
+
+
 class ServerConfig:
     port: int
     ip: str
+    pretty_json: bool
+    offload_json_size: int
+    compression: bool
+    compression_min_size: int
+    offload_compression_size: int
+    stream_stats_hits: int
+    workers: int
+    shared_dir: str
 
     def __init__(self, subyaml: dict):
         self.ip = subyaml.get("bind", "0.0.0.0")
         self.port = int(subyaml.get("port", 8080))
+        # Number of server processes sharing the port. Requires SO_REUSEPORT (Linux, BSD)
+        self.workers = int(subyaml.get("workers", 1))
+        # Directory in which workers share background data, edits and logouts. It must only be writable
+        # by the server user. Default (empty) is a new private directory in the temp dir, made at startup.
+        self.shared_dir = subyaml.get("shared_dir", "")
+        # Indent JSON responses, for debugging. Default is compact output.
+        self.pretty_json = bool(subyaml.get("pretty_json", False))
+        # Responses with more (estimated) items than this are encoded in the offloader instead of in the event loop
+        self.offload_json_size = int(subyaml.get("offload_json_size", 1000))
+        # Compress responses (gzip, or brotli if installed) for clients that accept it
+        self.compression = bool(subyaml.get("compression", True))
+        # Responses smaller than this (in bytes) are not worth compressing
+        self.compression_min_size = int(subyaml.get("compression_min_size", 1024))
+        # Responses larger than this (in bytes) are compressed in the offloader instead of in the event loop
+        self.offload_compression_size = int(subyaml.get("offload_compression_size", 262144))
+        # stats.lua results with more emails than this are streamed to the client as they are fetched,
+        # instead of being built in memory. Their encoding is still cached, if small enough. 0 to disable.
+        self.stream_stats_hits = int(subyaml.get("stream_stats_hits", 2500))
 
 
 class TaskConfig:
     refresh_rate: int
+    offload_threads: typing.Optional[int]
+    offload_processes: int
+    snapshot: str
+    snapshot_interval: int
 
     def __init__(self, subyaml: dict):
         self.refresh_rate = int(subyaml.get("refresh_rate", 150))
+        # Where to save lists, activity and session IDs for a warm start after a restart. Empty (default) to disable.
+        # The directory must only be writable by the server user, as the snapshot is trusted when loaded.
+        self.snapshot = subyaml.get("snapshot", "")
+        # How often to save the snapshot, in seconds. It is also saved on shutdown.
+        self.snapshot_interval = int(subyaml.get("snapshot_interval", 600))
+        # Number of threads for offloading blocking work. Default (None) is min(32, os.cpu_count() + 4)
+        self.offload_threads = subyaml.get("offload_threads")
+        if self.offload_threads is not None:
+            self.offload_threads = int(self.offload_threads)
+        # Number of processes for CPU heavy work (thread construction, JSON encoding). 0 means use threads.
+        self.offload_processes = int(subyaml.get("offload_processes", 0))
 
 
 class UIConfig:
@@ -82,6 +128,11 @@ class DBConfig:
     max_hits: int
     max_lists: int
     pool_size: int
+    slow_query_log: str
+    slow_query_threshold: float
+    slow_query_log_size: int
+    slow_query_log_backups: int
+    thread_index: bool
 
     def __init__(self, subyaml: dict):
         self.dburl = str(subyaml.get("dburl", ""))
@@ -93,6 +144,62 @@ class DBConfig:
         self.max_hits = int(subyaml.get("max_hits", 5000))
         self.max_lists = int(subyaml.get("max_lists", 8192))
         self.pool_size = int(subyaml.get("pool_size", 15))
+        # File to log Elasticsearch calls slower than slow_query_threshold (in seconds) to. Empty to disable.
+        self.slow_query_log = subyaml.get("slow_query_log", "")
+        self.slow_query_threshold = float(subyaml.get("slow_query_threshold", 1.0))
+        # The log is rotated when it grows beyond this size (in MB), keeping this many old logs
+        self.slow_query_log_size = int(subyaml.get("slow_query_log_size", 10)) * 1024 * 1024
+        self.slow_query_log_backups = int(subyaml.get("slow_query_log_backups", 5))
+        # Whether list views may use the thread summaries index instead of threading emails on every request
+        self.thread_index = bool(subyaml.get("thread_index", False))
+
+
+class CacheConfig:
+    stats_size: int
+    stats_max_age: int
+    stats_stale_time: int
+    sessions: int
+    unknown_sessions_ttl: int
+
+    def __init__(self, subyaml: dict):
+        # Memory cap for cached stats.lua results, in MB. 0 disables the cache.
+        self.stats_size = int(subyaml.get("stats_size", 64)) * 1024 * 1024
+        # Cached results older than this (in seconds) are always recomputed
+        self.stats_max_age = int(subyaml.get("stats_max_age", 3600))
+        # Results younger than this (in seconds) that only lack new emails are served while being refreshed
+        # in the background. Results that hidden, deleted or edited emails have changed are always recomputed.
+        self.stats_stale_time = int(subyaml.get("stats_stale_time", 60))
+        # Maximum number of user sessions kept in memory. Least recently used ones are looked up again in ES.
+        self.sessions = int(subyaml.get("sessions", 10000))
+        # How long (in seconds) to remember session cookies that are not in ES, instead of looking them up again
+        self.unknown_sessions_ttl = int(subyaml.get("unknown_sessions_ttl", 60))
+
+
+class AdmissionConfig:
+    enabled: bool
+    limits: typing.Dict[str, int]
+    max_wait: typing.Dict[str, float]
+    retry_after: int
+    crawler_agents: str
+
+    def __init__(self, subyaml: dict):
+        self.enabled = bool(subyaml.get("enabled", True))
+        # Concurrent requests per endpoint for each priority class. 0 means unlimited.
+        self.limits = {
+            "interactive": int(subyaml.get("interactive_limit", 0)),
+            "bulk": int(subyaml.get("bulk_limit", 4)),
+            "crawler": int(subyaml.get("crawler_limit", 2)),
+        }
+        # How long (in seconds) a request may wait for a slot before being turned away with a 503
+        self.max_wait = {
+            "interactive": float(subyaml.get("interactive_wait", 10)),
+            "bulk": float(subyaml.get("bulk_wait", 5)),
+            "crawler": float(subyaml.get("crawler_wait", 1)),
+        }
+        # Retry-After (in seconds) sent with 503 responses
+        self.retry_after = int(subyaml.get("retry_after", 30))
+        # Requests whose User-Agent matches this regex are treated as crawlers. Empty to disable.
+        self.crawler_agents = subyaml.get("crawler_agents", r"bot|crawl|spider|slurp")
 
 
 class Configuration:
@@ -101,6 +208,8 @@ class Configuration:
     tasks: TaskConfig
     oauth: OAuthConfig
     ui: UIConfig
+    cache: CacheConfig
+    admission: AdmissionConfig
 
     def __init__(self, yml: dict):
         self.server = ServerConfig(yml.get("server", {}))
@@ -108,6 +217,8 @@ class Configuration:
         self.tasks = TaskConfig(yml.get("tasks", {}))
         self.oauth = OAuthConfig(yml.get("oauth", {}))
         self.ui = UIConfig(yml.get("ui", {}))
+        self.cache = CacheConfig(yml.get("cache", {}))
+        self.admission = AdmissionConfig(yml.get("admission", {}))
 
 
 class InterData:
@@ -116,10 +227,20 @@ class InterData:
     """
 
     lists: dict
-    sessions: dict
+    sessions: plugins.cache.SessionCache
+    unknown_sessions: plugins.cache.NegativeCache
     activity: dict
+    edits: int
+    logged_out: typing.Dict[str, float]
 
-    def __init__(self):
+    def __init__(self, max_sessions: int = 10000, session_max_age: int = 86400 * 7, unknown_sessions_ttl: int = 60):
         self.lists = {}
-        self.sessions = {}
+        self.sessions = plugins.cache.SessionCache(max_sessions, session_max_age)
+        # Session IDs recently found not to exist (or to be expired or anonymous) in ES
+        self.unknown_sessions = plugins.cache.NegativeCache(max_sessions, unknown_sessions_ttl)
         self.activity = {}
+        # Number of changes made via the management console, as counted in the audit log. Part of the
+        # validators of ETags and cached results, as edits need not change the hits or dates of a query.
+        self.edits = 0
+        # Sessions logged out in this process, and when, for the other workers to drop too (see plugins.background)
+        self.logged_out = {}
@@ -19,12 +19,17 @@
 This is the Database library stub for Pony Mail codename Foal
 """
 
+import asyncio
+import time
 import uuid
 import typing
 import elasticsearch
 import elasticsearch.exceptions
 
 import plugins.configuration
+import plugins.metrics
+import plugins.profiler
+import plugins.slowlog
 
 
 class Timeout (elasticsearch.exceptions.ConnectionTimeout):
@@ -40,9 +45,11 @@ class DBNames:
         self.db_session = f"{dbprefix}-session"
         self.db_notification = f"{dbprefix}-notification"
         self.db_auditlog = f"{dbprefix}-auditlog"
+        self.db_threads = f"{dbprefix}-threads"
 
 
 DBError = elasticsearch.ElasticsearchException
+DBNotFound = elasticsearch.exceptions.NotFoundError
 
 
 class Database:
@@ -50,11 +57,26 @@ class Database:
     config: plugins.configuration.DBConfig
     dbs: DBNames
     uuid: str
+    metrics: typing.Optional[plugins.metrics.Metrics]
+    query_stats: typing.Optional[plugins.metrics.QueryStats]
+    profiler: typing.Optional[plugins.profiler.Profiler]
+    slowlog: typing.Optional[plugins.slowlog.SlowQueryLog]
+    endpoint: typing.Optional[str]
 
-    def __init__(self, config: plugins.configuration.DBConfig):
+    def __init__(
+        self,
+        config: plugins.configuration.DBConfig,
+        metrics: typing.Optional[plugins.metrics.Metrics] = None,
+        slowlog: typing.Optional[plugins.slowlog.SlowQueryLog] = None,
+    ):
         self.config = config
         self.uuid = str(uuid.uuid4())
         self.dbs = DBNames(config.db_prefix)
+        self.metrics = metrics
+        self.slowlog = slowlog
+        self.query_stats = None  # Set while checked out for a request
+        self.profiler = None  # Set while checked out for a request that is being profiled
+        self.endpoint = None  # Set while checked out for a request, for the slow query log
         if self.config.dburl:
             self.client = elasticsearch.AsyncElasticsearch([self.config.dburl, ])
         else:
@@ -69,11 +91,32 @@ class Database:
                 ]
             )
 
+    async def _call(self, operation: str, method: typing.Callable, **kwargs):
+        """Calls a client method, accounting for the time taken"""
+        started = time.time()
+        res = None
+        try:
+            res = await method(**kwargs)
+            return res
+        finally:
+            wall_time = time.time() - started
+            took = res.get("took", 0) / 1000 if isinstance(res, dict) else 0.0
+            if self.query_stats:
+                self.query_stats.add(took, wall_time)
+            if self.metrics:
+                self.metrics.observe_es(operation, wall_time, failed=res is None)
+            if self.profiler:
+                self.profiler.record_es(operation, kwargs, res, wall_time)
+            if self.slowlog:
+                self.slowlog.record(self.endpoint, operation, kwargs, res, took, wall_time)
+
     async def search(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_mbox
+        if self.profiler and self.profiler.es_profile and isinstance(kwargs.get("body"), dict):
+            kwargs["body"] = dict(kwargs["body"], profile=True)
         try:
-            res = await self.client.search(index=index, **kwargs)
+            res = await self._call("search", self.client.search, index=index, **kwargs)
             return res
         except elasticsearch.exceptions.ConnectionTimeout as e:
             raise Timeout(e)
@@ -81,35 +124,43 @@ class Database:
     async def get(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_mbox
-        res = await self.client.get(index=index, **kwargs)
+        res = await self._call("get", self.client.get, index=index, **kwargs)
         return res
 
     async def delete(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_session
-        res = await self.client.delete(index=index, **kwargs)
+        res = await self._call("delete", self.client.delete, index=index, **kwargs)
         return res
 
     async def index(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_session
-        res = await self.client.index(index=index, **kwargs)
+        res = await self._call("index", self.client.index, index=index, **kwargs)
         return res
 
     async def create(self, index=None, **kwargs):
         """Create a new document (put if missing)"""
-        res = await self.client.create(index=index, **kwargs)
+        res = await self._call("create", self.client.create, index=index, **kwargs)
         return res
 
     async def info(self, **kwargs):
         """Get ES info"""
-        res = await self.client.info(**kwargs)
+        res = await self._call("info", self.client.info, **kwargs)
         return res
 
     async def update(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_session
-        res = await self.client.update(index=index, **kwargs)
+        res = await self._call("update", self.client.update, index=index, **kwargs)
+        return res
+
+    async def bulk(self, **kwargs):
+        res = await self._call("bulk", self.client.bulk, **kwargs)
+        return res
+
+    async def msearch(self, **kwargs):
+        res = await self._call("msearch", self.client.msearch, **kwargs)
         return res
 
     async def scan(self,
@@ -138,8 +189,8 @@ class Database:
         try:
             while scroll_id and resp["hits"]["hits"]:
                 yield resp["hits"]["hits"]
-                resp = await self.client.scroll(
-                    body={"scroll_id": scroll_id, "scroll": scroll}, **scroll_kwargs
+                resp = await self._call(
+                    "scroll", self.client.scroll, body={"scroll_id": scroll_id, "scroll": scroll}, **scroll_kwargs
                 )
                 scroll_id = resp.get("_scroll_id")
 
@@ -148,3 +199,134 @@ class Database:
             if scroll_id and clear_scroll:
                 # ignore is a valid keyword!
                 await self.client.clear_scroll(body={"scroll_id": [scroll_id]}, ignore=(404,)) # pylint: disable=unexpected-keyword-arg
+
+
+class DatabasePool:
+    """A pool of database connections for async queries, keeping tabs on how long callers wait for one"""
+
+    config: plugins.configuration.DBConfig
+    dbs: DBNames
+    queue: asyncio.Queue
+
+    def __init__(
+        self,
+        config: plugins.configuration.DBConfig,
+        metrics: typing.Optional[plugins.metrics.Metrics] = None,
+        slowlog: typing.Optional[plugins.slowlog.SlowQueryLog] = None,
+    ):
+        self.config = config
+        self.dbs = DBNames(config.db_prefix)
+        self.queue = asyncio.Queue()
+        if config.pool_size < 1:
+            raise ValueError(f"pool_size {config.pool_size} must be > 0")
+        for _ in range(0, config.pool_size): # stop value is exclusive
+            self.queue.put_nowait(Database(config, metrics, slowlog))
+        self.checkouts = 0
+        self.wait_time = 0.0  # Total time spent waiting for a free connection
+        self.max_wait_time = 0.0
+
+    async def get(self) -> Database:
+        """Checks a connection out of the pool, waiting for one to become free if need be"""
+        start = time.time()
+        database = await self.queue.get()
+        waited = time.time() - start
+        self.checkouts += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return database
+
+    def put(self, database: Database) -> None:
+        """Returns a connection to the pool"""
+        self.queue.put_nowait(database)
+        self.queue.task_done()
+
+    async def close(self) -> None:
+        while not self.queue.empty():
+            await self.queue.get_nowait().client.close()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.config.pool_size,
+            "available": self.queue.qsize(),
+            "checkouts": self.checkouts,
+            "wait_time": self.wait_time,
+            "max_wait_time": self.max_wait_time,
+        }
+
+
+class LazyDatabase:
+    """
+    Database handle for a single request. A connection is only checked out of the pool
+    on first use, and must be handed back with release() once the request is done.
+    """
+
+    config: plugins.configuration.DBConfig
+    dbs: DBNames
+    pool: DatabasePool
+    database: typing.Optional[Database]
+    query_stats: plugins.metrics.QueryStats
+    profiler: typing.Optional[plugins.profiler.Profiler]
+    endpoint: typing.Optional[str]
+    lock: asyncio.Lock
+
+    def __init__(self, pool: DatabasePool):
+        self.pool = pool
+        self.config = pool.config
+        self.dbs = pool.dbs
+        self.database = None
+        self.query_stats = plugins.metrics.QueryStats()
+        self.profiler = None
+        self.endpoint = None
+        self.lock = asyncio.Lock()  # Queries run concurrently by a request share a single connection
+
+    async def checkout(self) -> Database:
+        if self.database is None:
+            async with self.lock:
+                if self.database is None:
+                    with plugins.profiler.span(self.profiler, "db_pool_wait"):
+                        database = await self.pool.get()
+                    database.query_stats = self.query_stats
+                    database.profiler = self.profiler
+                    database.endpoint = self.endpoint
+                    self.database = database
+        return self.database
+
+    def release(self) -> None:
+        if self.database is not None:
+            self.database.query_stats = None
+            self.database.profiler = None
+            self.database.endpoint = None
+            self.pool.put(self.database)
+            self.database = None
+
+    async def search(self, index="", **kwargs):
+        return await (await self.checkout()).search(index=index, **kwargs)
+
+    async def get(self, index="", **kwargs):
+        return await (await self.checkout()).get(index=index, **kwargs)
+
+    async def delete(self, index="", **kwargs):
+        return await (await self.checkout()).delete(index=index, **kwargs)
+
+    async def index(self, index="", **kwargs):
+        return await (await self.checkout()).index(index=index, **kwargs)
+
+    async def create(self, index=None, **kwargs):
+        return await (await self.checkout()).create(index=index, **kwargs)
+
+    async def info(self, **kwargs):
+        return await (await self.checkout()).info(**kwargs)
+
+    async def update(self, index="", **kwargs):
+        return await (await self.checkout()).update(index=index, **kwargs)
+
+    async def bulk(self, **kwargs):
+        return await (await self.checkout()).bulk(**kwargs)
+
+    async def msearch(self, **kwargs):
+        return await (await self.checkout()).msearch(**kwargs)
+
+    async def scan(self, **kwargs) -> typing.AsyncIterator[typing.List[dict]]:
+        database = await self.checkout()
+        async for hits in database.scan(**kwargs):
+            yield hits
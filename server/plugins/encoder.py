@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the response encoding library for Pony Mail codename Foal.
+It turns endpoint output into JSON bytes, using orjson if it is installed.
+"""
+
+import json
+import typing
+
+import plugins.offloader
+
+try:
+    import orjson  # Optional, much faster than the built-in json module
+except ImportError:
+    orjson = None
+
+
+def encode(output: typing.Any, pretty: bool = False) -> bytes:
+    """Encodes a JSON-compatible object as UTF-8 JSON bytes, compact unless pretty is set"""
+    if orjson:
+        options = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            options |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(output, option=options)
+        except (orjson.JSONEncodeError, TypeError):
+            pass  # Fall back to the json module, which copes with e.g. very large integers
+    if pretty:
+        return json.dumps(output, indent=2, ensure_ascii=False).encode("utf-8")
+    return json.dumps(output, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def encode_members(output: typing.Union[dict, list]) -> bytes:
+    """Encodes the members of a JSON object or array without the enclosing braces, for streaming a larger one"""
+    return encode(output)[1:-1]
+
+
+def estimated_size(output: typing.Any, depth: int = 2) -> int:
+    """Returns a rough count of the items in a response, for deciding whether the encoding is worth offloading"""
+    if depth > 0:
+        if isinstance(output, dict):
+            return len(output) + sum(estimated_size(v, depth - 1) for v in output.values())
+        if isinstance(output, list):
+            return len(output) + sum(estimated_size(v, depth - 1) for v in output)
+    return 1
+
+
+async def encode_async(
+    runners: plugins.offloader.ExecutorPool, output: typing.Any, pretty: bool = False, offload_size: int = 0
+) -> bytes:
+    """Encodes a response, offloading the work to the executor pool if the response is large"""
+    if estimated_size(output) > offload_size:
+        return await runners.run_cpu(encode, output, pretty)
+    return encode(output, pretty)
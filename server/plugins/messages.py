@@ -26,6 +26,7 @@ import base64
 import binascii
 import datetime
 import email.utils
+import fnmatch
 import hashlib
 
 # Main imports
@@ -42,11 +43,18 @@ DATABASE_NOT_CONNECTED = "Database not connected!"
 OLD_SHORTENED_ID_LENGTH = 18  # Thread IDs of 18 char length (deprecated) need special care in searches
 NEEDS_QUOTES = re.compile(r'[][\\()<>@,:;".]')  # If these characters are present in an email display name, quote it
 ESCAPES_RE = re.compile(r'[\\"]')  # Characters to escape with backslash in make_address()
+ANONYMIZE_ADDRESS_RE = re.compile(r"(\S{1,2})\S*@([-a-zA-Z0-9_.]+)")
+ANONYMIZE_BODY_RE = re.compile(r"<(\S{1,2})\S*@([-a-zA-Z0-9_.]+)>")
+ANONYMIZED_FIELDS = ("from", "to", "cc")  # Headers the archiver stores anonymised in _anonymized
 
 mbox_cache_privacy: typing.Dict[str, bool] = {}
 
 # This is used to detect if the '...' truncation marker is to be added
 SHORT_BODY_MAX_LEN = 200  # This must be the same as Archiver.SHORT_BODY_MAXLEN
+THREAD_MAX_DEPTH = 250  # Maximum number of reply generations fetched for a thread
+THREAD_MAX_REPLIES = 250  # Maximum number of replies fetched per email in a generation
+MAX_RESULT_WINDOW = 10000  # Elasticsearch's default index.max_result_window
+THREAD_QUERY_CHUNK = 200  # Message-ids per thread query, well within ES's default indices.query.bool.max_clause_count
 
 # Only these fields are returned by the API:
 # (keep this list sorted)
@@ -110,7 +118,7 @@ def anonymize_mail_address(emailstring: str) -> str:
     # split the email list into individual entries
     for real, addr in email.utils.getaddresses([emailstring]):
         # generate the anonymised entries
-        anon = re.sub(r"(\S{1,2})\S*@([-a-zA-Z0-9_.]+)", "\\1...@\\2", addr)
+        anon = ANONYMIZE_ADDRESS_RE.sub("\\1...@\\2", addr)
         out.append(make_address(real, anon))
 
     # rejoin one per line
@@ -123,16 +131,20 @@ def anonymize(doc: dict) -> dict:
     if "_source" in doc:
         ptr = doc["_source"]
 
-    if "from" in ptr:
-        ptr["from"] = anonymize_mail_address(ptr["from"])
-    if "to" in ptr:
-        ptr["to"] = anonymize_mail_address(ptr["to"])
-    if "cc" in ptr:
-        ptr["cc"] = anonymize_mail_address(ptr["cc"])
-    if "body" in ptr and ptr["body"]:
-        ptr["body"] = re.sub(
-            r"<(\S{1,2})\S*@([-a-zA-Z0-9_.]+)>", "<\\1...@\\2>", ptr["body"]
-        )
+    # Use the values stored at archive time, unless the header has been edited since
+    anonymized: typing.Dict[str, typing.Any] = {}
+    stored_fields = ptr.pop("_anonymized", None)
+    if isinstance(stored_fields, dict):
+        anonymized = stored_fields
+    for header in ANONYMIZED_FIELDS:
+        if header in ptr:
+            stored = anonymized.get(header)
+            if stored and stored[0] == ptr[header]:
+                ptr[header] = stored[1]
+            else:
+                ptr[header] = anonymize_mail_address(ptr[header])
+    if "body" in ptr and ptr["body"] and "@" in ptr["body"]:
+        ptr["body"] = ANONYMIZE_BODY_RE.sub("<\\1...@\\2>", ptr["body"])
     return doc
 
 
@@ -140,11 +152,18 @@ async def find_parent(session, doc: typing.Dict[str, str]):
     """
     Locates the first email in a thread by going back through all the
     in-reply-to headers and finding their ancestor.
+    The ancestors named in the references and in-reply-to headers are fetched in one
+    query; another query is only needed when an ancestor's parent was not among them.
+    If the chain is broken, the oldest accessible ancestor found is used instead.
     """
+    known: typing.Dict[str, dict] = {}
+    requested: typing.Set[str] = set()
+    visited: typing.Set[str] = set()
     step = 0
     # max 50 steps up in the hierarchy
     while step < 50:
         step = step + 1
+        visited.add(doc.get("message-id", ""))
         irt: typing.Optional[str] = doc["in-reply-to"] if "in-reply-to" in doc else None
         if not irt:
             break  # Shouldn't happen because irt is always present currently
@@ -153,59 +172,177 @@ async def find_parent(session, doc: typing.Dict[str, str]):
         if not m:
             break
         ref = m.group(1)
-        newdoc = await get_email(session, messageid=ref)
-        # Did we find something accessible?
+        if ref not in requested:
+            ancestors = [ref] + re.findall(r"<[^>]+>", doc.get("references") or "")
+            ancestors = [message_id for message_id in ancestors if message_id not in requested]
+            requested.update(ancestors)
+            known.update(await get_emails_by_message_id(session, ancestors, doc.get("list_raw")))
+        newdoc = known.get(ref)
         if not newdoc:
-            break
+            # Chain is broken, continue from the oldest older ancestor we know of, if any
+            candidates = [
+                xdoc for message_id, xdoc in known.items()
+                if message_id not in visited and xdoc.get("epoch", 0) < doc.get("epoch", 0)
+            ]
+            if not candidates:
+                break
+            newdoc = min(candidates, key=lambda xdoc: xdoc.get("epoch", 0))
         doc = newdoc
     return doc
 
 
+async def get_emails_by_message_id(
+    session: plugins.session.SessionObject, message_ids: typing.List[str], list_raw: typing.Optional[str] = None
+) -> typing.Dict[str, dict]:
+    """
+    Returns the accessible mbox documents with any of the given message-ids, by message-id.
+    If a message-id was archived in several lists, the copy in list_raw is preferred.
+    """
+    assert session.database, DATABASE_NOT_CONNECTED
+    message_ids = list(dict.fromkeys(message_ids))  # Unique, in order
+    if not message_ids:
+        return {}
+    res = await session.database.search(
+        index=session.database.dbs.db_mbox,
+        size=min(len(message_ids) * 5, MAX_RESULT_WINDOW),  # Allow for cross-posts
+        body={"query": {"bool": {"must": [{"terms": {"message-id": message_ids}}]}}},
+    )
+    docs: typing.Dict[str, dict] = {}
+    access = plugins.aaa.get_access(session)
+    for hit in res["hits"]["hits"]:
+        doc = check_access(session, hit["_source"], access)
+        if doc and (doc["message-id"] not in docs or doc.get("list_raw") == list_raw):
+            docs[doc["message-id"]] = doc
+    return docs
+
+
+def check_access(
+    session: plugins.session.SessionObject, doc: dict, access: typing.Optional[plugins.aaa.Access] = None
+) -> typing.Optional[dict]:
+    """
+    Prepares an mbox document for use, if the session may see it.
+    Returns None for inaccessible documents, and for deleted ones unless the session is admin.
+    Loops over many documents should pass the session's access object along.
+    """
+    doc["id"] = doc["mid"]
+    # If deleted by UI, only return if session is admin
+    is_admin = session.credentials and session.credentials.admin
+    if doc.get("deleted", False) and not is_admin:
+        return None
+    if (access or plugins.aaa.get_access(session)).can_access_email(doc):
+        if not session.credentials:
+            doc = anonymize(doc)
+        trim_email(doc)
+        return doc
+    return None
+
+
 async def fetch_children(session: plugins.session.SessionObject,
         pdoc: dict,
         counter: int = 0,
         pdocs: typing.Optional[dict] = None,
         short: bool = False) -> typing.Tuple[list,list,dict]:
     """
-    Fetches all accessible child messages of a parent email
+    Fetches all accessible child messages of a parent email.
+    If the archiver stamped the email with its thread, the whole thread is fetched in one query.
+    Otherwise, each generation of replies is fetched with a single query for all the
+    message-ids found in the previous one, for at most THREAD_MAX_DEPTH generations.
+    Returns the child tree, a list of emails (always empty, kept for compatibility)
+    and a dict of all the children found, by mid.
     """
     if pdocs is None:
         pdocs = {}
-    counter = counter + 1
-    if counter > 250:
-        return [], [], {}
-    docs: typing.List[dict] = await get_email_irt(session, pdoc["message-id"])
-
-    thread = []
-    emails = []
-    for doc in docs:
-        if doc["mid"] not in pdocs:
-            mykids, _myemails, pdocs = await fetch_children(
-                session, doc, counter, pdocs, short=short
-            )
-            if short:
-                xdoc = {
-                    "tid": doc["mid"],
-                    "mid": doc["mid"],
-                    "message-id": doc["message-id"],
-                    "subject": doc["subject"],
-                    "from": doc["from"],
-                    "id": doc["mid"],
-                    "epoch": doc["epoch"],
-                    "children": mykids,
-                    "irt": doc["in-reply-to"],
-                    "list_raw": doc["list_raw"],
-                }
-                thread.append(xdoc)
-                pdocs[doc["mid"]] = xdoc
-            else:
-                thread.append(doc)
-                pdocs[doc["mid"]] = doc
-            for kid in mykids:
-                if kid["mid"] not in pdocs:
-                    pdocs[kid["mid"]] = kid
-                    emails.append(kid)
-    return thread, emails, pdocs
+    thread: typing.List[dict] = []
+    # Children lists of all placed emails by message-id, so replies can be attached to their closest known ancestor
+    placed: typing.Dict[str, list] = {pdoc["message-id"]: thread}
+    if pdoc.get("thread"):
+        docs = await get_thread_emails(session, pdoc["thread"])
+        place_replies(docs, placed, pdocs, short)
+        return thread, [], pdocs
+
+    # Legacy emails without thread info
+    # Message-ids of the emails whose replies are to be fetched next
+    frontier: typing.List[str] = [pdoc["message-id"]]
+    while frontier and counter < THREAD_MAX_DEPTH:
+        counter += 1
+        docs = await get_email_irt(session, frontier)
+        frontier = place_replies(docs, placed, pdocs, short)
+    return thread, [], pdocs
+
+
+def place_replies(docs: typing.List[dict], placed: typing.Dict[str, list], pdocs: dict, short: bool) -> typing.List[str]:
+    """
+    Adds emails to the thread tree, under their closest placed ancestor. Emails without one are skipped.
+    Returns the message-ids of the newly placed emails.
+    """
+    new_ids = []
+    # Older emails first, so an email is always placed before its replies
+    for doc in sorted(docs, key=lambda d: d.get("epoch", 0)):
+        if doc["mid"] in pdocs:
+            continue
+        parent_children = find_siblings(doc, placed)
+        if parent_children is None:
+            continue
+        if short:
+            xdoc = {
+                "tid": doc["mid"],
+                "mid": doc["mid"],
+                "message-id": doc["message-id"],
+                "subject": doc["subject"],
+                "from": doc["from"],
+                "id": doc["mid"],
+                "epoch": doc["epoch"],
+                "children": [],
+                "irt": doc["in-reply-to"],
+                "list_raw": doc["list_raw"],
+            }
+        else:
+            xdoc = doc
+            xdoc["children"] = []
+        parent_children.append(xdoc)
+        pdocs[doc["mid"]] = xdoc
+        message_id = doc.get("message-id")
+        if message_id and message_id not in placed:
+            placed[message_id] = xdoc["children"]
+            new_ids.append(message_id)
+    return new_ids
+
+
+async def get_thread_emails(session: plugins.session.SessionObject, thread_id: str) -> typing.List[dict]:
+    """
+    Returns the accessible emails stamped with a thread ID by the archiver, oldest first.
+    """
+    assert session.database, DATABASE_NOT_CONNECTED
+    res = await session.database.search(
+        index=session.database.dbs.db_mbox,
+        size=MAX_RESULT_WINDOW,
+        body={"query": {"bool": {"must": [{"term": {"thread": thread_id}}]}}, "sort": [{"epoch": "asc"}]},
+    )
+    docs = []
+    access = plugins.aaa.get_access(session)
+    for hit in res["hits"]["hits"]:
+        doc = check_access(session, hit["_source"], access)
+        if doc:
+            docs.append(doc)
+    return docs
+
+
+def find_siblings(doc: dict, placed: typing.Dict[str, list]) -> typing.Optional[list]:
+    """
+    Returns the children list of the closest already placed ancestor of an email:
+    its in-reply-to if placed, otherwise the last placed message-id in its references
+    """
+    irt = doc.get("in-reply-to")
+    if irt and irt in placed:
+        return placed[irt]
+    for ref in reversed(re.findall(r"<[^>]+>", doc.get("references") or "")):
+        if ref in placed:
+            return placed[ref]
+    # Matched on a partial message-id, attach it to the best match we can find
+    for message_id, children in placed.items():
+        if message_id in (irt or "") or message_id in (doc.get("references") or ""):
+            return children
+    return None
 
 
 async def get_email(
@@ -254,54 +391,40 @@ async def get_email(
 
     # Did we find a single doc?
     if doc and isinstance(doc, dict):
-        doc = doc["_source"]
-        doc["id"] = doc["mid"]
-        # If deleted by UI, only return if session is admin
-        is_admin = session.credentials and session.credentials.admin
-        if doc.get("deleted", False) and not is_admin:
-            return None
-        if doc and plugins.aaa.can_access_email(session, doc):
-            trim_email(doc)
-            if not session.credentials:
-                doc = anonymize(doc)
-            return doc
+        return check_access(session, doc["_source"])
 
     # no doc?
     return None
 
 async def get_email_irt(
     session: plugins.session.SessionObject,
-    irt: str,
+    irt: typing.Union[str, typing.List[str]],
+    size: int = THREAD_MAX_REPLIES,
 ) -> typing.List[dict]:
     """
     Returns a list of mbox document(s) that are related,
-    i.e. where the parameter matches 'in-reply-to' or 'references'
+    i.e. where the parameter (or any of the parameters, if a list) matches 'in-reply-to' or 'references'
+    At most size documents are fetched per message-id, with one query per THREAD_QUERY_CHUNK message-ids.
     May be empty.
     Docs have been checked for accessibility.
     """
     assert session.database, DATABASE_NOT_CONNECTED
     doctype = session.database.dbs.db_mbox
+    message_ids = [irt] if isinstance(irt, str) else irt
 
-    xirt = '"%s"' % irt.replace('"', '\\"')
-    res = await session.database.search(
-        index=doctype,
-        size=250,
-        body={"query": {"bool": {"must": [ {"simple_query_string": { "query": xirt, "fields":["in-reply-to", "references"]}}]}}},
-    )
-    docs = res["hits"]["hits"]
-
-    is_admin = session.credentials and session.credentials.admin
     docs_returned = []
-    for doc in docs:
-        doc = doc["_source"]
-        doc["id"] = doc["mid"]
-        if doc.get("deleted", False) and not is_admin:
-            continue
-        if doc and plugins.aaa.can_access_email(session, doc):
-            trim_email(doc)
-            if not session.credentials:
-                doc = anonymize(doc)
-            docs_returned.append(doc)
+    access = plugins.aaa.get_access(session)
+    for i in range(0, len(message_ids), THREAD_QUERY_CHUNK):
+        chunk = message_ids[i : i + THREAD_QUERY_CHUNK]
+        res = await session.database.search(
+            index=doctype,
+            size=min(size * len(chunk), MAX_RESULT_WINDOW),
+            body={"query": {"bool": thread_query(*chunk)}},
+        )
+        for doc in res["hits"]["hits"]:
+            doc = check_access(session, doc["_source"], access)
+            if doc:
+                docs_returned.append(doc)
     return docs_returned
 
 
@@ -358,7 +481,11 @@ async def query_batch(
         for hdr in MUST_HAVE:
             if not hdr in source_fields:
                 temp.append(hdr)
+        if not session.credentials and any(hdr in source_fields for hdr in ANONYMIZED_FIELDS):
+            temp.append("_anonymized")
         es_query["_source"] = temp
+    elif session.credentials:  # The stored anonymised fields are only of use to anonymous sessions
+        es_query["_source"] = { "excludes": ["body", "_anonymized"] }
     else:
         es_query["_source"] = { "excludes": ["body"] }
     async for hits in session.database.scan(
@@ -366,13 +493,14 @@ async def query_batch(
         preserve_order=preserve_order
     ):
         is_admin = session.credentials and session.credentials.admin
+        access = plugins.aaa.get_access(session)
         docs = []
         for hit in hits:
             doc = hit["_source"]
             # If email was delete/hidden and we're not doing an admin query, ignore it
             if doc.get("deleted", False) and not is_admin:
                 continue
-            if plugins.aaa.can_access_email(session, doc):
+            if access.can_access_email(doc):
                 if "mid" in doc: # might be missing when using source_fields
                     doc["id"] = doc["mid"]
                 # Calculate gravatars if not present in _source
@@ -457,6 +585,21 @@ async def wordcloud(session: plugins.session.SessionObject, query_defuzzed: dict
         pass
     return wc
 
+def in_list_scope(list_clause: dict, list_raw: str) -> bool:
+    """Returns whether a list matches the list_raw term or wildcard clause of a defuzzed query"""
+    for kind, field in list_clause.items():
+        pattern = field.get("list_raw") if isinstance(field, dict) else None
+        if isinstance(pattern, dict):
+            pattern = pattern.get("value")
+        if not isinstance(pattern, str):
+            break
+        if kind == "term":
+            return list_raw == pattern
+        if kind == "wildcard":
+            return fnmatch.fnmatchcase(list_raw, pattern)
+    return True  # Not a list clause we know, so it may match any list
+
+
 async def get_accessible_filter(session: plugins.session.SessionObject, query_defuzzed: dict) -> typing.Optional[list]:
     """
     Return a filter to be applied to the query to exclude inaccessible mails.
@@ -465,44 +608,70 @@ async def get_accessible_filter(session: plugins.session.SessionObject, query_de
     query_filter = get_accessible_filter(session, query)
     if query_filter:
         query['filter'] = query_filter
+    Unless the session can access all lists, the private lists it can access are taken from its
+    access object (see plugins.aaa.get_access), which is based on the background list directory.
     """
-    if not session.credentials:
-        # if no credentials, only need to search public mails
+    access = plugins.aaa.get_access(session)
+    if access.allow_all:  # Nothing to filter out
+        return None
+    # which accessible private lists might be involved in the search?
+    list_clause = query_defuzzed["must"][0]
+    private_lists_accessible = sorted(
+        list_raw for list_raw in access.lists if in_list_scope(list_clause, list_raw)
+    )
+
+    # Search public emails, and those of the private lists we can access
+    if not private_lists_accessible:  # No private lists accessible, just filter for public
         return [{"term": {"private": False}}]
-    # which private lists might be involved in the search?
-    fuzz_private_only = dict(query_defuzzed)
-    fuzz_private_only["filter"] = [{"term": {"private": True}}]
+    return [
+        {"bool": {"should": [{"term": {"private": False}}, {"terms": {"list_raw": private_lists_accessible}}]}}
+    ]
+
+
+async def get_validator(session: plugins.session.SessionObject, query_defuzzed: dict) -> typing.Tuple[int, int, int]:
+    """
+    Fetches a cheap summary of the documents matching a query, for detecting changes:
+    number of hits, newest epoch and number of hidden (deleted) documents.
+    The query must include a private filter if necessary
+    """
     assert session.database, DATABASE_NOT_CONNECTED
-    max_lists = session.database.config.max_lists
     res = await session.database.search(
         index=session.database.dbs.db_mbox,
         size=0,
-        body={
-            "query": {"bool": fuzz_private_only},
-            "aggs": {"listnames": {"terms": {"field": "list_raw", "size": max_lists}}},
-        },
+        track_total_hits=True,
+        body={"query": {"bool": query_defuzzed},
+            "aggs": {
+                "newest": {"max": {"field": "epoch"}},
+                "hidden": {"filter": {"term": {"deleted": True}}},
+            },
+        }
     )
-    private_lists_found = []
-    for entry in res["aggregations"]["listnames"]["buckets"]:
-        listname = entry["key"].lower()
-        private_lists_found.append(listname)
-
-    # If we can access all private lists found, or if no private lists, we can do a complete search.
-    # If not, we adjust the search here to only include public emails OR private lists we can access.
-    private_lists_accessible = []
-    for listname in private_lists_found:
-        if plugins.aaa.can_access_list(session, listname):
-            private_lists_accessible.append(listname)
-    
-    # If we can't access all private lists found, either only public emails or lists we can access.
-    if not private_lists_accessible:  # No private lists accessible, just filter for public
-        return [{"term": {"private": False}}]
-    elif private_lists_found != private_lists_accessible:  # Some private lists, search for public OR those..
-        return [
-            {"bool": {"should": [{"term": {"private": False}}, {"terms": {"list_raw": private_lists_accessible}}]}}
-        ]
+    hits = res["hits"]["total"]["value"]
+    newest = int(res["aggregations"]["newest"]["value"] or 0)
+    hidden = res["aggregations"]["hidden"]["doc_count"]
+    return hits, newest, hidden
 
-    return None
+
+def thread_query(*message_ids: str) -> dict:
+    """
+    Returns a (bool) query matching the emails referring to any of the message-ids.
+    in-reply-to is a keyword, so takes a single terms clause. references is text, and needs
+    a phrase (clause) per message-id, so pass at most THREAD_QUERY_CHUNK of them.
+    """
+    xirt = " | ".join('"%s"' % message_id.replace('"', '\\"') for message_id in message_ids)
+    return {
+        "must": [
+            {
+                "bool": {
+                    "should": [
+                        {"terms": {"in-reply-to": list(message_ids)}},
+                        {"simple_query_string": {"query": xirt, "fields": ["references"]}},
+                    ],
+                    "minimum_should_match": 1,
+                }
+            }
+        ]
+    }
 
 
 async def get_activity_span(session: plugins.session.SessionObject, query_defuzzed: dict) -> typing.Tuple[datetime.datetime, datetime.datetime, dict]:
@@ -546,8 +715,8 @@ async def get_activity_span(session: plugins.session.SessionObject, query_defuzz
 
 
 class ThreadConstructor:
-    def __init__(self, emails: typing.List[typing.Dict]):
-        self.emails = emails
+    def __init__(self, emails: typing.Optional[typing.List[typing.Dict]] = None):
+        self.emails = emails or []
         self.threads: typing.List[dict] = []
         # this now includes the gravatar, to avoid issues with address anonymisation
         self.authors: typing.Dict[str, list] = {}
@@ -556,7 +725,13 @@ class ThreadConstructor:
 
     def construct(self):
         """Turns a flat array of emails into a nested structure of threads"""
-        for cur_email in sorted(self.emails, key=lambda x: x["epoch"]):
+        self.add(sorted(self.emails, key=lambda x: x["epoch"]))
+        return self.threads, self.authors
+
+    def add(self, emails: typing.Iterable[typing.Dict]):
+        """Threads a batch of emails, e.g. a page of query_batch results.
+        Emails must arrive in epoch order, oldest first, across batches as well."""
+        for cur_email in emails:
             author = cur_email.get("from")
             assert(author)
             if author not in self.authors:
@@ -587,30 +762,122 @@ class ThreadConstructor:
             self.hashed_by_msg_id[cur_email.get("message-id", "??")] = xemail
             if tsubject not in self.hashed_by_subject:
                 self.hashed_by_subject[tsubject] = xemail
-        return self.threads, self.authors
 
-    
     def find_root_subject(self, root_email: typing.Dict[str, str], osubject: typing.Optional[str] = None) -> typing.Optional[dict]:
         """Finds the discussion origin of an email, if present"""
         irt = root_email.get("in-reply-to",'')
-        subject = root_email.get("subject",'')
-        subject = subject.replace("\n", "").strip()  # Crop multi-line subjects and surrounding whitespace
-        subject = PYPONY_RE_PREFIX.sub("", subject) + "_" + root_email.get("list_raw",'')
+        # add() passes the subject it has already normalised, so it is only worked out here for other callers
+        rsubject = osubject or self.normalise_subject(root_email)
 
         # First, the obvious - look for an in-reply-to in our existing dict with a matching subject
         if irt and irt in self.hashed_by_msg_id:
-            if self.hashed_by_msg_id[irt].get("subject") == subject:
+            if self.hashed_by_msg_id[irt].get("subject", "") == rsubject:
                 return self.hashed_by_msg_id[irt]
 
         # If that failed, we break apart our subject
-        if osubject:
-            rsubject = osubject
-        else:
-            rsubject = subject
         if rsubject and rsubject in self.hashed_by_subject:
             return self.hashed_by_subject[rsubject]
         return None
 
+    @staticmethod
+    def normalise_subject(root_email: typing.Dict[str, str]) -> str:
+        subject = root_email.get("subject",'')
+        subject = subject.replace("\n", "").strip()  # Crop multi-line subjects and surrounding whitespace
+        return PYPONY_RE_PREFIX.sub("", subject) + "_" + root_email.get("list_raw",'')
+
+
+async def get_thread_summaries(
+    session: plugins.session.SessionObject, query_defuzzed: dict, emails: typing.List[dict]
+) -> typing.Optional[typing.List[dict]]:
+    """
+    Fetches the thread summaries (see tools/build-thread-index.py) overlapping the emails of a list view.
+    Returns None if the query is more than a list and date range, or if no (complete) summaries can be had.
+    """
+    must = query_defuzzed["must"]
+    if not emails or query_defuzzed.get("must_not") or any("range" not in clause for clause in must[1:]):
+        return None
+    epochs = [cur_email["epoch"] for cur_email in emails]
+    assert session.database, DATABASE_NOT_CONNECTED
+    try:
+        res = await session.database.search(
+            index=session.database.dbs.db_threads,
+            size=MAX_RESULT_WINDOW,
+            body={
+                "query": {
+                    "bool": {
+                        "must": [
+                            must[0],  # The list(s) of the view
+                            {"range": {"last_epoch": {"gte": min(epochs)}}},
+                            {"range": {"first_epoch": {"lte": max(epochs)}}},
+                        ],
+                        "filter": query_defuzzed.get("filter", []),
+                    }
+                },
+                "_source": ["list_raw", "tree", "truncated"],
+            },
+        )
+    except plugins.database.DBError:  # Most likely, the threads index has not been set up
+        return None
+    hits = res["hits"]["hits"]
+    if len(hits) >= MAX_RESULT_WINDOW or any(hit["_source"].get("truncated") for hit in hits):
+        return None
+    return [hit["_source"] for hit in hits]
+
+
+def project_thread_summaries(
+    summaries: typing.List[dict], emails: typing.List[dict]
+) -> typing.Optional[typing.Tuple[typing.List[dict], typing.Dict[str, list]]]:
+    """
+    Turns thread summaries into threads and authors in the format of ThreadConstructor.construct, keeping
+    only the given emails. Replies to emails left out move up to their closest ancestor that is kept.
+    The summaries only provide the structure; subjects and dates come from the emails, which may have been
+    edited since they were archived.
+    Threads follow the reply headers, as in thread.lua, whereas ThreadConstructor groups emails by subject.
+    This is intended, but means the two differ when the subject and reply headers disagree: a reply with a
+    new subject stays in its thread, and unrelated emails with the same subject are not merged.
+    Returns None if the summaries do not cover all of the emails, e.g. when they have not been built yet.
+    """
+    wanted = {cur_email["mid"]: cur_email for cur_email in emails}
+    placed: typing.Set[str] = set()
+    threads: typing.List[dict] = []
+    xemails: typing.List[dict] = []
+    for summary in summaries:
+        todo: typing.List[typing.Tuple[dict, typing.Optional[dict]]] = [(summary["tree"], None)]
+        while todo:
+            node, parent = todo.pop()
+            cur_email = wanted.get(node["mid"])
+            if cur_email and node["mid"] not in placed:
+                subject = cur_email.get("subject", "").replace("\n", "")
+                xemail = {
+                    "children": [],
+                    "tid": node["mid"],
+                    "subject": subject,
+                    "tsubject": PYPONY_RE_PREFIX.sub("", subject) + "_" + cur_email.get("list_raw", "<a.b.c.d>"),
+                    "epoch": cur_email.get("epoch"),
+                    "nest": parent["nest"] + 1 if parent else 1,
+                }
+                if parent:
+                    parent["children"].append(xemail)
+                else:
+                    threads.append(xemail)
+                xemails.append(xemail)
+                placed.add(node["mid"])
+                parent = xemail
+            todo.extend((child, parent) for child in reversed(node["children"]))
+    if len(placed) < len(wanted):
+        return None
+    for xemail in xemails:
+        xemail["children"].sort(key=lambda x: x["epoch"])
+    threads.sort(key=lambda x: x["epoch"])
+
+    authors: typing.Dict[str, list] = {}
+    for cur_email in emails:
+        author = cur_email.get("from", "")
+        if author not in authors:
+            authors[author] = [0, cur_email.get("gravatar", "")]
+        authors[author][0] += 1
+    return threads, authors
+
 
 
 def gravatar(eml: typing.Union[str, dict]) -> str:
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the metrics library for Pony Mail codename Foal.
+It keeps latency histograms and counters for API requests and Elasticsearch
+calls, and renders them (along with gauges from other plugins) in the
+Prometheus text exposition format.
+"""
+
+import bisect
+import typing
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+PREFIX = "ponymail"
+
+
+class QueryStats:
+    """Elasticsearch call accounting for a single request"""
+
+    calls: int
+    took: float
+    wall_time: float
+
+    def __init__(self):
+        self.calls = 0
+        self.took = 0.0  # Time spent inside ES, as reported by ES, in seconds
+        self.wall_time = 0.0  # Round trip time, in seconds
+
+    def add(self, took: float, wall_time: float) -> None:
+        self.calls += 1
+        self.took += took
+        self.wall_time += wall_time
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, as used by Prometheus"""
+
+    def __init__(self, buckets: typing.Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> typing.List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        labels = labels.rstrip(",")
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _labels(**labels: str) -> str:
+    """Formats labels for a metric line, with a trailing comma"""
+    return "".join('%s="%s",' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items())
+
+
+class Metrics:
+    """All the metrics of a server process"""
+
+    def __init__(self):
+        self.request_latency: typing.Dict[str, Histogram] = {}
+        self.responses: typing.Dict[typing.Tuple[str, int], int] = {}
+        self.request_es_calls: typing.Dict[str, Histogram] = {}
+        self.request_es_took: typing.Dict[str, Histogram] = {}
+        self.request_es_time: typing.Dict[str, Histogram] = {}
+        self.es_latency: typing.Dict[str, Histogram] = {}
+        self.es_errors: typing.Dict[str, int] = {}
+        # Callables returning a dict of current values, e.g. the stats() of the database pool
+        self.gauges: typing.Dict[str, typing.Callable[[], dict]] = {}
+        # The keys of each of those that only ever go up, exported as counters
+        self.counters: typing.Dict[str, typing.FrozenSet[str]] = {}
+
+    def add_gauges(self, name: str, source: typing.Callable[[], dict], counters: typing.Iterable[str] = ()) -> None:
+        self.gauges[name] = source
+        self.counters[name] = frozenset(counters)
+
+    def observe_request(
+        self, endpoint: str, status: int, duration: float, query_stats: typing.Optional[QueryStats] = None
+    ) -> None:
+        """Records a finished API request"""
+        self.request_latency.setdefault(endpoint, Histogram()).observe(duration)
+        self.responses[(endpoint, status)] = self.responses.get((endpoint, status), 0) + 1
+        if query_stats:
+            self.request_es_calls.setdefault(endpoint, Histogram(COUNT_BUCKETS)).observe(query_stats.calls)
+            self.request_es_took.setdefault(endpoint, Histogram()).observe(query_stats.took)
+            self.request_es_time.setdefault(endpoint, Histogram()).observe(query_stats.wall_time)
+
+    def observe_es(self, operation: str, wall_time: float, failed: bool = False) -> None:
+        """Records a single Elasticsearch call"""
+        self.es_latency.setdefault(operation, Histogram()).observe(wall_time)
+        if failed:
+            self.es_errors[operation] = self.es_errors.get(operation, 0) + 1
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text format"""
+        lines = []
+
+        def histograms(name: str, kind: str, helptext: str, data: typing.Dict[str, Histogram], label: str):
+            lines.append(f"# HELP {PREFIX}_{name} {helptext}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for key, histogram in sorted(data.items()):
+                lines.extend(histogram.render(f"{PREFIX}_{name}", _labels(**{label: key})))
+
+        histograms("request_duration_seconds", "histogram", "API request latency", self.request_latency, "endpoint")
+        lines.append(f"# HELP {PREFIX}_responses_total API responses by status code")
+        lines.append(f"# TYPE {PREFIX}_responses_total counter")
+        for (endpoint, status), count in sorted(self.responses.items()):
+            lines.append(f"{PREFIX}_responses_total{{{_labels(endpoint=endpoint, status=str(status)).rstrip(',')}}} {count}")
+        histograms(
+            "request_es_calls", "histogram", "Elasticsearch calls per API request", self.request_es_calls, "endpoint"
+        )
+        histograms(
+            "request_es_took_seconds", "histogram", "Elasticsearch reported time (took) per API request",
+            self.request_es_took, "endpoint",
+        )
+        histograms(
+            "request_es_round_trip_seconds", "histogram", "Elasticsearch round trip time per API request",
+            self.request_es_time, "endpoint",
+        )
+        histograms("es_duration_seconds", "histogram", "Elasticsearch call latency", self.es_latency, "operation")
+        lines.append(f"# HELP {PREFIX}_es_errors_total Failed Elasticsearch calls")
+        lines.append(f"# TYPE {PREFIX}_es_errors_total counter")
+        for operation, count in sorted(self.es_errors.items()):
+            lines.append(f"{PREFIX}_es_errors_total{{{_labels(operation=operation).rstrip(',')}}} {count}")
+
+        for source, getter in sorted(self.gauges.items()):
+            for key, value in sorted(getter().items()):
+                if not isinstance(value, (bool, int, float)):
+                    continue
+                if key in self.counters[source]:
+                    lines.append(f"# TYPE {PREFIX}_{source}_{key}_total counter")
+                    lines.append(f"{PREFIX}_{source}_{key}_total {float(value)}")
+                else:
+                    lines.append(f"# TYPE {PREFIX}_{source}_{key} gauge")
+                    lines.append(f"{PREFIX}_{source}_{key} {float(value)}")
+        return "\n".join(lines) + "\n"
@@ -15,37 +15,88 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Offloading library for pushing heavy tasks to sub threads"""
+"""Offloading library for pushing heavy tasks to sub threads or sub processes"""
 
 import asyncio
 import concurrent.futures
+import time
+import typing
 
 DEBUG = False
 
 
+def _timed_call(func, args, kwargs) -> typing.Tuple[float, typing.Any]:
+    """Runs a task inside the executor, noting when it actually started running.
+    This needs to be a module level function so it can be pickled for process pools."""
+    started = time.time()
+    return started, func(*args, **kwargs)
+
+
 class ExecutorPool:
-    """A pool of runners for offloading blocking processes to threads, so that async processing can continue"""
+    """A pool of runners for offloading blocking processes to threads (or processes), so that async
+    processing can continue"""
 
-    def __init__(self, threads=None):
+    def __init__(self, threads: typing.Optional[int] = None, processes: int = 0):
         # If no thread count is specified, will default to: min(32, os.cpu_count() + 4)
         self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        # CPU bound tasks can optionally be sent to a pool of processes, to get around the GIL
+        self.processes: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if processes > 0:
+            self.processes = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        # Counters for keeping tabs on how busy the pool is
+        self.pending = 0  # Queue depth: tasks submitted and not yet finished
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0  # Total time tasks have spent waiting for a free runner
+        self.max_wait_time = 0.0
 
     async def run(self, func, *args, **kwargs):
+        """Runs a blocking task in the thread pool and waits for the result"""
+        return await self._submit(self.threads, func, *args, **kwargs)
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """Runs a CPU bound task in the process pool if one is configured, otherwise in the thread pool.
+        Function, arguments and return value must all be picklable when a process pool is in use."""
+        return await self._submit(self.processes or self.threads, func, *args, **kwargs)
+
+    async def _submit(self, executor: concurrent.futures.Executor, func, *args, **kwargs):
         if DEBUG:
             print("[Runner] initiating runner")
-        runner = self.threads.submit(func, *args, **kwargs)
+        submitted = time.time()
+        self.pending += 1
+        runner = executor.submit(_timed_call, func, args, kwargs)
         if DEBUG:
             print("[Runner] Waiting for task %r to finish" % func)
-        while runner.running():
-            await asyncio.sleep(0.01)
         try:
-            rv = runner.result()
-        except Exception as e:
-            rv = e
-        if DEBUG:
-            print("[Runner] Done with task %r, put runner back in queue" % func)
-        if isinstance(rv, BaseException):
+            started, rv = await asyncio.wrap_future(runner)
+        except Exception:
+            self.failed += 1
             if DEBUG:
                 print("[Runner] Task %r encountered an exception during run." % func)
-            raise rv
+            raise
+        finally:
+            self.pending -= 1
+        waited = max(0.0, started - submitted)
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        self.completed += 1
+        if DEBUG:
+            print("[Runner] Done with task %r after waiting %.3fs for a runner" % (func, waited))
         return rv
+
+    def stats(self) -> dict:
+        """Returns the current queue depth and wait time counters"""
+        return {
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_time": self.wait_time,
+            "max_wait_time": self.max_wait_time,
+            "processes": self.processes is not None,
+        }
+
+    def shutdown(self):
+        """Shuts down the thread and process pools"""
+        self.threads.shutdown(wait=False)
+        if self.processes:
+            self.processes.shutdown(wait=False)
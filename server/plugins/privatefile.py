@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for the files the server keeps state in between runs or shares between workers.
+What is read from them is trusted (list privacy, sessions), so they must live in a
+directory only the server user can write to, and are never followed through symlinks.
+"""
+
+import os
+import stat
+import tempfile
+
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+
+def check_owned(st: os.stat_result, what: str) -> None:
+    """Raises PermissionError unless a file or directory is ours and not writable by others"""
+    if st.st_uid != os.geteuid():
+        raise PermissionError(f"{what} is not owned by the server user")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{what} is writable by other users")
+
+
+def check_directory(path: str) -> None:
+    """Raises PermissionError unless the directory of a file is private to the server user"""
+    directory = os.path.dirname(os.path.abspath(path))
+    check_owned(os.stat(directory), directory)
+
+
+def read(path: str) -> bytes:
+    """Reads a private file. Raises PermissionError if it or its directory could have been written by others."""
+    check_directory(path)
+    fd = os.open(path, os.O_RDONLY | O_NOFOLLOW)
+    with os.fdopen(fd, "rb") as f:
+        check_owned(os.fstat(f.fileno()), path)
+        return f.read()
+
+
+def write(path: str, data: bytes) -> None:
+    """Writes a private file atomically, via a new temporary file in the same directory"""
+    check_directory(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the request profiling library for Pony Mail codename Foal.
+Admins can ask for a timing breakdown of a request, covering each step of an
+endpoint, every Elasticsearch call (with its query and 'took') and the
+serialization of the response. Optionally, the ES profile API output and a
+cProfile summary can be included as well. cProfile sees the whole process, so
+requests asking for it are profiled one at a time, and its summary also covers
+whatever else the server did meanwhile.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import io
+import pstats
+import time
+import typing
+
+CPROFILE_ENTRIES = 40  # Number of functions to list in the cProfile summary
+CPROFILE_SCOPE = "whole server process, including any other requests served during this one"
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("profiler_span", default=None)
+
+
+class CProfileLock:
+    """Held by the request being profiled with cProfile"""
+
+    def __init__(self):
+        self.lock: typing.Optional[asyncio.Lock] = None  # Created on first use, inside the event loop
+
+    async def acquire(self) -> None:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        await self.lock.acquire()
+
+    def release(self) -> None:
+        if self.lock:
+            self.lock.release()
+
+
+_cprofile_lock = CProfileLock()
+
+
+class Span:
+    """A timed step of a request, with any sub-steps"""
+
+    def __init__(self, profiler: "Profiler", name: str, data: typing.Optional[dict] = None):
+        self.profiler = profiler
+        self.name = name
+        self.data = data or {}
+        self.started = time.time()
+        self.duration: typing.Optional[float] = None
+        self.children: typing.List[Span] = []
+
+    def finish(self) -> None:
+        self.duration = time.time() - self.started
+
+    def to_dict(self) -> dict:
+        duration = self.duration if self.duration is not None else time.time() - self.started
+        out = {
+            "name": self.name,
+            "offset_ms": round((self.started - self.profiler.root.started) * 1000, 3),
+            "duration_ms": round(duration * 1000, 3),
+        }
+        out.update(self.data)
+        if self.children:
+            out["children"] = [child.to_dict() for child in self.children]
+        return out
+
+
+class Profiler:
+    """Collects the timing tree of a single request"""
+
+    def __init__(self, es_profile: bool = False, cprofile: bool = False):
+        self.es_profile = es_profile  # Ask ES to profile searches
+        self.root = Span(self, "request")
+        self.cprofile: typing.Optional[cProfile.Profile] = cProfile.Profile() if cprofile else None
+        self.cprofiling = False  # Whether this request holds the cProfile lock
+
+    def _parent(self) -> Span:
+        parent = _current_span.get()
+        if parent is None or parent.profiler is not self:
+            return self.root
+        return parent
+
+    @contextlib.contextmanager
+    def span(self, name: str, **data) -> typing.Iterator[Span]:
+        """Times a step of the request. Steps started inside it are recorded as its children."""
+        step = Span(self, name, data)
+        self._parent().children.append(step)
+        token = _current_span.set(step)
+        try:
+            yield step
+        finally:
+            step.finish()
+            _current_span.reset(token)
+
+    def record_es(self, operation: str, kwargs: dict, res: typing.Any, wall_time: float) -> None:
+        """Records a finished Elasticsearch call"""
+        data: typing.Dict[str, typing.Any] = {"operation": operation}
+        for key in ("index", "id", "body", "size"):
+            if key in kwargs:
+                data[key] = kwargs[key]
+        if isinstance(res, dict):
+            if "took" in res:
+                data["took_ms"] = res["took"]
+            if isinstance(res.get("hits"), dict):
+                data["hits"] = res["hits"].get("total")
+            if "profile" in res:
+                data["es_profile"] = res["profile"]
+        else:
+            data["failed"] = True
+        call = Span(self, f"es:{operation}", data)
+        call.started = time.time() - wall_time
+        call.duration = wall_time
+        self._parent().children.append(call)
+
+    async def start(self) -> None:
+        """Starts cProfile if asked for, once no other request is being profiled with it"""
+        if self.cprofile:
+            with self.span("cprofile_wait"):
+                await _cprofile_lock.acquire()
+            self.cprofiling = True
+            self.cprofile.enable()
+
+    def stop(self) -> None:
+        self.root.finish()
+        if self.cprofiling and self.cprofile:
+            self.cprofile.disable()
+            self.cprofiling = False
+            _cprofile_lock.release()
+
+    def to_dict(self) -> dict:
+        out = self.root.to_dict()
+        if self.cprofile:
+            stream = io.StringIO()
+            pstats.Stats(self.cprofile, stream=stream).sort_stats("cumulative").print_stats(CPROFILE_ENTRIES)
+            out["cprofile_scope"] = CPROFILE_SCOPE
+            out["cprofile"] = stream.getvalue()
+        return out
+
+
+def span(profiler: typing.Optional[Profiler], name: str, **data) -> typing.ContextManager:
+    """Times a step of a request if it is being profiled, otherwise does nothing"""
+    if profiler:
+        return profiler.span(name, **data)
+    return contextlib.nullcontext()
+
+
+def from_flag(flag: str) -> Profiler:
+    """Creates a profiler from the value of the profile request parameter, e.g. 'es,cprofile'"""
+    options = [option.strip() for option in flag.lower().split(",")]
+    return Profiler(es_profile="es" in options, cprofile="cprofile" in options)
@@ -23,22 +23,31 @@ import typing
 import aiohttp
 from elasticsearch import AsyncElasticsearch
 
+import plugins.admission
+import plugins.cache
 import plugins.configuration
+import plugins.database
+import plugins.metrics
 import plugins.offloader
+import plugins.slowlog
 
 
 class Endpoint:
     exec: typing.Callable
+    priority: str
 
-    def __init__(self, executor):
+    def __init__(self, executor, priority: str = plugins.admission.INTERACTIVE):
         self.exec = executor
+        self.priority = priority  # Priority class for admission control
 
 
 class StreamingEndpoint:
     exec: typing.Callable
+    priority: str
 
-    def __init__(self, executor):
+    def __init__(self, executor, priority: str = plugins.admission.INTERACTIVE):
         self.exec = executor
+        self.priority = priority  # Priority class for admission control
 
 
 class BaseServer:
@@ -49,9 +58,16 @@ class BaseServer:
     data: plugins.configuration.InterData
     handlers: typing.Dict[str, Endpoint]
     database: AsyncElasticsearch
-    dbpool: asyncio.Queue
+    dbpool: plugins.database.DatabasePool
+    slowlog: typing.Optional[plugins.slowlog.SlowQueryLog]
+    admission: plugins.admission.AdmissionControl
     runners: plugins.offloader.ExecutorPool
+    stats_cache: plugins.cache.ResultCache
+    metrics: plugins.metrics.Metrics
     streamlock: asyncio.Lock
+    workers: int
+    worker_id: int
+    shared_dir: str  # Only set if workers > 1
     # provided by background.py
     library_version: str
     engine_version: str
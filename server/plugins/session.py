@@ -17,6 +17,7 @@
 
 """This is the user session handler for PyPony"""
 
+import asyncio
 import http.cookies
 import time
 import typing
@@ -25,6 +26,7 @@ import uuid
 import aiohttp.web
 
 import plugins.database
+import plugins.profiler
 import plugins.server
 import copy
 
@@ -67,10 +69,14 @@ class SessionObject:
     created: int
     last_accessed: int
     credentials: typing.Optional[SessionCredentials]
-    database: typing.Optional[plugins.database.Database]
+    database: typing.Optional[plugins.database.LazyDatabase]
     remote: str
     host: str
     server: plugins.server.BaseServer
+    if_none_match: str
+    response_headers: dict
+    profiler: typing.Optional[plugins.profiler.Profiler]
+    access_memo: dict
 
     def __init__(self, server: plugins.server.BaseServer, **kwargs):
         self.database = None
@@ -78,6 +84,10 @@ class SessionObject:
         self.created = int(time.time())
         self.host = "??"
         self.remote = "??"
+        self.if_none_match = ""
+        self.response_headers = {}
+        self.profiler = None
+        self.access_memo = {}  # Shared by the per-request copies of a cached session, see plugins.aaa
         if kwargs:
             self.last_accessed = kwargs.get("last_accessed", 0)
             self.credentials = SessionCredentials(kwargs.get("credentials"))
@@ -90,6 +100,13 @@ class SessionObject:
             self.cid = None
 
 
+def set_request_data(session: SessionObject, request: aiohttp.web.BaseRequest):
+    """Sets the per-request data of a session object"""
+    session.if_none_match = request.headers.get("If-None-Match", "")
+    session.response_headers = {}  # Must not be shared with the cached session object
+    session.profiler = None
+
+
 async def get_session(
     server: plugins.server.BaseServer, request: aiohttp.web.BaseRequest
 ) -> SessionObject:
@@ -107,78 +124,116 @@ async def get_session(
                     session_id = None
                 break
 
-    # Do we have the session in local memory?
-    if session_id and session_id in server.data.sessions:
-        x_session = server.data.sessions[session_id]
-        if (now - x_session.last_accessed) > FOAL_MAX_SESSION_AGE:
-            del server.data.sessions[session_id]
-        else:
-
-            # Make a copy so we don't have a race condition with the database pool object
-            # In case the session is used twice within the same loop
-            session = copy.copy(x_session)
-            session.database = await server.dbpool.get()
-            session.host = request.headers.get("X-Forwarded-Host", request.host)
-            session.remote = request.remote
-
-            # Do we need to update the timestamp in ES?
-            if (now - session.last_accessed) > FOAL_SAVE_SESSION_INTERVAL:
-                session.last_accessed = now
-                await save_session(session)
-
-            return session
-
-    # If not in local memory, start a new session object
+    # Do we have the session in local memory? If not, look for a session object in ES,
+    # unless we recently found it to be unusable
+    x_session = server.data.sessions.lookup(session_id, now) if session_id else None
+    if x_session:
+        # Do we need to update the timestamp in ES? This is done in bulk in the background.
+        if session_id and (now - x_session.last_accessed) > FOAL_SAVE_SESSION_INTERVAL:
+            server.data.sessions.touch(session_id, now)
+    elif session_id and session_id not in server.data.unknown_sessions:
+        x_session = await hydrate_session(server, session_id)
+
+    if x_session:
+        # Make a copy so we don't have a race condition with the database pool object
+        # In case the session is used twice within the same loop
+        session = copy.copy(x_session)
+        session.database = plugins.database.LazyDatabase(server.dbpool)
+        session.host = request.headers.get("X-Forwarded-Host", request.host)
+        session.remote = request.remote
+        set_request_data(session, request)
+        return session
+
+    # Otherwise, start a new session object
     session = SessionObject(server)
-    session.database = await server.dbpool.get()
+    # A connection is only checked out of the pool if the session or endpoint needs one
+    session.database = plugins.database.LazyDatabase(server.dbpool)
     session.host = request.headers.get("X-Forwarded-Host", request.host or "??")
     session.remote = request.remote or "??"
-
-    # If a cookie was supplied, look for a session object in ES
-    if session_id and session.database:
-        try:
-            session_doc = await session.database.get(
-                session.database.dbs.db_session, id=session_id
-            )
-            last_update = session_doc["_source"]["updated"]
-            session.cookie = session_id
-            # Check that this cookie ain't too old. If it is, delete it and return bare-bones session object
-            if (now - last_update) > FOAL_MAX_SESSION_AGE:
-                await session.database.delete(
-                    index=session.database.dbs.db_session, id=session_id
-                )
-                return session
-
-            # Get CID and fecth the account data
-            cid = session_doc["_source"]["cid"]
-            if cid:
-                account_doc = await session.database.get(
-                    session.database.dbs.db_account, id=cid
-                )
-                creds = account_doc["_source"]["credentials"]
-                internal = account_doc["_source"]["internal"]
-
-                # Set session data
-                session.cid = cid
-                session.last_accessed = last_update
-                creds["authoritative"] = (
-                    internal.get("oauth_provider")
-                    in server.config.oauth.authoritative_domains
-                )
-                creds["oauth_provider"] = internal.get("oauth_provider", OAUTH_PROVIDER_DEFAULT)
-                creds["oauth_data"] = internal.get("oauth_data", {})
-                # We update admin boolean whenever we fetch session doc, as they may have changed in yaml but not in ES.
-                creds["admin"] = creds["authoritative"] and creds.get('email') in server.config.oauth.admins
-                session.credentials = SessionCredentials(creds)
-
-                # Save in memory storage
-                server.data.sessions[session_id] = session
-
-        except plugins.database.DBError:
-            pass
+    set_request_data(session, request)
     return session
 
 
+async def hydrate_session(server: plugins.server.BaseServer, session_id: str) -> typing.Optional[SessionObject]:
+    """Loads a session from ES into local memory. Concurrent requests for the same session share one lookup."""
+    hydrating = server.data.sessions.hydrating
+    if session_id not in hydrating:
+        hydrating[session_id] = asyncio.ensure_future(fetch_session(server, session_id))
+        hydrating[session_id].add_done_callback(lambda _task: hydrating.pop(session_id, None))
+    # Shielded, so one client going away does not cancel the lookup for the others
+    return await asyncio.shield(hydrating[session_id])
+
+
+async def fetch_session(server: plugins.server.BaseServer, session_id: str) -> typing.Optional[SessionObject]:
+    """
+    Fetches a session and its account in a single round trip, and caches it if usable.
+    The account is found through a terms lookup on the cid of the session document.
+    """
+    now = int(time.time())
+    database = plugins.database.LazyDatabase(server.dbpool)
+    try:
+        res = await database.msearch(
+            body=[
+                {"index": database.dbs.db_session},
+                {"query": {"ids": {"values": [session_id]}}, "size": 1},
+                {"index": database.dbs.db_account},
+                {
+                    "query": {
+                        "terms": {"_id": {"index": database.dbs.db_session, "id": session_id, "path": "cid"}}
+                    },
+                    "size": 1,
+                },
+            ]
+        )
+        session_res, account_res = res["responses"]
+        if session_res.get("hits", {}).get("hits"):
+            session_doc = session_res["hits"]["hits"][0]
+            account_doc = (account_res.get("hits", {}).get("hits") or [None])[0]
+        else:
+            # Searches only see documents after an index refresh, so check a brand new session with a (realtime) get
+            session_doc = await database.get(database.dbs.db_session, id=session_id)
+            account_doc = None
+        last_update = session_doc["_source"]["updated"]
+        # Check that this cookie ain't too old. If it is, delete it
+        if (now - last_update) > FOAL_MAX_SESSION_AGE:
+            server.data.unknown_sessions.add(session_id)
+            await database.delete(index=database.dbs.db_session, id=session_id)
+            return None
+
+        # Get CID and fetch the account data, if the lookup did not find it
+        cid = session_doc["_source"]["cid"]
+        if not cid:  # Anonymous session, nothing to cache
+            server.data.unknown_sessions.add(session_id)
+            return None
+        if not account_doc:
+            account_doc = await database.get(database.dbs.db_account, id=cid)
+        creds = account_doc["_source"]["credentials"]
+        internal = account_doc["_source"]["internal"]
+
+        # Set session data
+        session = SessionObject(server, last_accessed=last_update, cookie=session_id, cid=cid)
+        creds["authoritative"] = (
+            internal.get("oauth_provider")
+            in server.config.oauth.authoritative_domains
+        )
+        creds["oauth_provider"] = internal.get("oauth_provider", OAUTH_PROVIDER_DEFAULT)
+        creds["oauth_data"] = internal.get("oauth_data", {})
+        # We update admin boolean whenever we fetch session doc, as they may have changed in yaml but not in ES.
+        creds["admin"] = creds["authoritative"] and creds.get('email') in server.config.oauth.admins
+        session.credentials = SessionCredentials(creds)
+
+        # Save in memory storage
+        server.data.sessions[session_id] = session
+        return session
+    except plugins.database.DBNotFound:
+        server.data.unknown_sessions.add(session_id)
+    except plugins.database.DBError:
+        pass
+    finally:
+        database.release()
+    return None
+
+
 async def set_session(server: plugins.server.BaseServer, cid: str, **credentials):
     """Create a new user session in the database"""
     session_id = str(uuid.uuid4())
@@ -189,17 +244,20 @@ async def set_session(server: plugins.server.BaseServer, cid: str, **credentials
     )
     session.credentials = SessionCredentials(credentials)
     server.data.sessions[session_id] = session
+    server.data.unknown_sessions.discard(session_id)
 
     # Grab temporary DB handle since session objects at init do not have this
     # We just need this to be able to save the session in ES.
-    session.database = await server.dbpool.get()
+    session.database = plugins.database.LazyDatabase(server.dbpool)
 
     # Save session and account data
-    await save_session(session)
-    await save_credentials(session)
-
-    # Put DB handle back into the pool
-    server.dbpool.put_nowait(session.database)
+    try:
+        await save_session(session)
+        await save_credentials(session)
+    finally:
+        # Put DB handle back into the pool
+        session.database.release()
+        session.database = None
     return cookie["ponymail"].OutputString()
 
 
@@ -217,6 +275,46 @@ async def save_session(session: SessionObject):
     )
 
 
+async def save_sessions(server: plugins.server.BaseServer):
+    """
+    Saves the pending last access times of cached sessions in the ES database, in one bulk request.
+    Sessions deleted from ES in the meantime (logged out, revoked or expired) are not recreated,
+    but dropped from memory. Failed updates are retried on the next run.
+    """
+    sessions = server.data.sessions.take_dirty()
+    if not sessions:
+        return
+    database = plugins.database.LazyDatabase(server.dbpool)
+    actions: typing.List[dict] = []
+    for session in sessions:
+        actions.append({"update": {"_index": database.dbs.db_session, "_id": session.cookie}})
+        actions.append({"doc": {"updated": session.last_accessed}})
+    try:
+        res = await database.bulk(body=actions)
+    except plugins.database.DBError as e:
+        print("Could not save session updates, will retry: %s" % e)
+        server.data.sessions.requeue(sessions)
+        return
+    finally:
+        database.release()
+    if not res.get("errors"):
+        return
+    failed = []
+    for session, item in zip(sessions, res["items"]):
+        error = item.get("update", {}).get("error")
+        if not error:
+            continue
+        if error.get("type") == "document_missing_exception":
+            if session.cookie in server.data.sessions:
+                del server.data.sessions[session.cookie]
+            server.data.unknown_sessions.add(session.cookie)
+        else:
+            failed.append(session)
+    if failed:
+        print("%u session updates could not be saved, will retry" % len(failed))
+        server.data.sessions.requeue(failed)
+
+
 async def remove_session(session: SessionObject):
     """Remove a session object in the ES database"""
     assert session.database, DATABASE_NOT_CONNECTED
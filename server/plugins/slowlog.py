@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the slow query log library for Pony Mail codename Foal.
+Elasticsearch calls slower than a threshold are logged as JSON lines to a
+rotating file. Writing happens in a background thread, so the event loop
+never blocks on disk I/O. See tools/slow-queries.py for aggregating the log.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import time
+import typing
+
+import plugins.configuration
+
+
+class SlowQueryLog:
+    """Rotating log of slow Elasticsearch calls"""
+
+    def __init__(self, config: plugins.configuration.DBConfig, suffix: str = ""):
+        self.threshold = config.slow_query_threshold
+        self.handler = logging.handlers.RotatingFileHandler(
+            config.slow_query_log + suffix,
+            maxBytes=config.slow_query_log_size,
+            backupCount=config.slow_query_log_backups,
+        )
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.logger = logging.getLogger(f"ponymail.slowlog.{id(self)}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(logging.handlers.QueueHandler(self.queue))
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+        self.listener.start()
+
+    def record(
+        self,
+        endpoint: typing.Optional[str],
+        operation: str,
+        kwargs: dict,
+        res: typing.Any,
+        took: float,
+        wall_time: float,
+    ) -> None:
+        """Logs an Elasticsearch call if it was slower than the threshold"""
+        if wall_time < self.threshold:
+            return
+        hits = None
+        if isinstance(res, dict):
+            total = res.get("hits", {}).get("total")
+            hits = total.get("value") if isinstance(total, dict) else total
+            if hits is None and "found" in res:
+                hits = 1 if res["found"] else 0
+        entry = {
+            "timestamp": time.time(),
+            "endpoint": endpoint,
+            "operation": operation,
+            "index": kwargs.get("index"),
+            "body": kwargs.get("body"),
+            "size": kwargs.get("size"),
+            "hits": hits,
+            "took": took,
+            "wall_time": wall_time,
+            "failed": res is None,
+        }
+        self.logger.info(json.dumps(entry, default=str))
+
+    def close(self) -> None:
+        """Writes out any pending entries and closes the log"""
+        self.listener.stop()
+        self.handler.close()
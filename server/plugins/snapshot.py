@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the warm-start snapshot library for Pony Mail codename Foal.
+The background data (lists, activity, versions) and the IDs of the sessions in
+the in-memory cache are saved to disk periodically and on shutdown, and loaded
+again at startup, so a restarted server can answer requests right away while the
+background tasks refresh the data. Sessions are looked up again in ES rather than
+restored from the file, so logged out or revoked sessions stay gone, and
+credentials and admin rights always come from ES and the configuration.
+"""
+
+import asyncio
+import json
+import time
+
+import plugins.encoder
+import plugins.privatefile
+import plugins.server
+import plugins.session
+
+SNAPSHOT_VERSION = 2
+WARM_SESSIONS_CONCURRENCY = 8  # Sessions looked up in ES at the same time when warming the cache
+
+
+def take(server: plugins.server.BaseServer) -> dict:
+    """Returns a snapshot of the data worth keeping across restarts"""
+    sessions = sorted(server.data.sessions.items(), key=lambda item: item[1].last_accessed, reverse=True)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "created": time.time(),
+        "lists": server.data.lists,
+        "activity": server.data.activity,
+        "library_version": getattr(server, "library_version", None),
+        "engine_version": getattr(server, "engine_version", None),
+        "session_ids": [session_id for session_id, _session in sessions],  # Most recently used first
+    }
+
+
+async def save(server: plugins.server.BaseServer, path: str) -> None:
+    """Saves a snapshot, writing the file in the offloader"""
+    data = plugins.encoder.encode(take(server))
+    await server.runners.run(plugins.privatefile.write, path, data)
+
+
+def save_now(server: plugins.server.BaseServer, path: str) -> None:
+    """Saves a snapshot without the event loop, for use on shutdown"""
+    plugins.privatefile.write(path, plugins.encoder.encode(take(server)))
+
+
+def load(server: plugins.server.BaseServer, path: str) -> bool:
+    """Loads a snapshot if there is a usable one, and starts warming the session cache.
+    Returns True if one was loaded."""
+    try:
+        snapshot = json.loads(plugins.privatefile.read(path))
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print("Could not load snapshot from %s: %s" % (path, e))
+        return False
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return False
+
+    server.data.lists = snapshot.get("lists") or {}
+    server.data.activity = snapshot.get("activity") or {}
+    if snapshot.get("library_version"):
+        server.library_version = snapshot["library_version"]
+    if snapshot.get("engine_version"):
+        server.engine_version = snapshot["engine_version"]
+    session_ids = [
+        session_id
+        for session_id in snapshot.get("session_ids") or []
+        if isinstance(session_id, str) and all(c in "abcdefg1234567890-" for c in session_id)
+    ]
+    asyncio.ensure_future(warm_sessions(server, session_ids))
+    now = int(time.time())
+    print(
+        "Loaded snapshot from %s (%u lists, %u sessions to look up, %u seconds old)"
+        % (path, len(server.data.lists), len(session_ids), now - snapshot.get("created", now))
+    )
+    return True
+
+
+async def warm_sessions(server: plugins.server.BaseServer, session_ids: list) -> None:
+    """Looks up the sessions of the last run in ES, a few at a time, so their users find them cached"""
+    session_ids = session_ids[: server.data.sessions.max_entries]
+    for i in range(0, len(session_ids), WARM_SESSIONS_CONCURRENCY):
+        await asyncio.gather(
+            *(
+                plugins.session.hydrate_session(server, session_id)
+                for session_id in session_ids[i : i + WARM_SESSIONS_CONCURRENCY]
+                if session_id not in server.data.sessions
+            )
+        )
+
+
+async def run_snapshots(server: plugins.server.BaseServer, path: str) -> None:
+    """Saves a snapshot every tasks/snapshot_interval seconds, until the server is asked to stop"""
+    while True:
+        try:
+            await asyncio.wait_for(server.background_event.wait(), timeout=server.config.tasks.snapshot_interval)
+            break # if the event is set, then we have been asked to stop
+        except asyncio.TimeoutError:
+            pass # This is normal
+        try:
+            await save(server, path)
+        except OSError as e:
+            print("Could not save snapshot to %s: %s" % (path, e))
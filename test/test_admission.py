@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# To be run as: python3 -m pytest test/test_admission.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("aiohttp")  # Needs the server requirements
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from plugins.admission import Budget  # noqa: E402
+
+
+def test_budget_unlimited():
+    async def run():
+        budget = Budget(0)
+        for _ in range(100):
+            assert await budget.acquire(0)
+        assert budget.active == 100
+
+    asyncio.run(run())
+
+
+def test_budget_rejects_when_full():
+    async def run():
+        budget = Budget(2)
+        assert await budget.acquire(0)
+        assert await budget.acquire(0)
+        assert not await budget.acquire(0)
+        assert not await budget.acquire(0.01)  # Times out
+        assert not budget.waiters
+        budget.release()
+        assert await budget.acquire(0)
+        assert budget.active == 2
+
+    asyncio.run(run())
+
+
+def test_budget_hands_slots_over_in_order():
+    async def run():
+        budget = Budget(1)
+        assert await budget.acquire(0)
+        order = []
+
+        async def wait(name):
+            if await budget.acquire(5):
+                order.append(name)
+
+        waiters = [asyncio.ensure_future(wait(name)) for name in ("first", "second")]
+        await asyncio.sleep(0)
+        assert len(budget.waiters) == 2
+        assert not await budget.acquire(0)  # Does not jump the queue
+        budget.release()
+        await asyncio.sleep(0.01)
+        assert order == ["first"]
+        assert budget.active == 1  # Handed over, not given back
+        budget.release()
+        await asyncio.gather(*waiters)
+        assert order == ["first", "second"]
+        budget.release()
+        assert budget.active == 0
+
+    asyncio.run(run())
+
+
+def test_budget_cancelled_waiter():
+    async def run():
+        budget = Budget(1)
+        assert await budget.acquire(0)
+        waiter = asyncio.ensure_future(budget.acquire(5))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not budget.waiters
+        budget.release()
+        assert budget.active == 0
+
+    asyncio.run(run())
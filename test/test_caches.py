@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_caches.py
+# This ensures sys.path is set up correctly
+
+import types
+
+from server.plugins.cache import NegativeCache, ResultCache, SessionCache
+
+
+def make_session(cookie, last_accessed=1000):
+    return types.SimpleNamespace(cookie=cookie, last_accessed=last_accessed)
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(max_size=30, max_age=60, stale_time=10)
+    cache.put("a", "A", "va", 10)
+    cache.put("b", "B", "vb", 10)
+    cache.put("c", "C", "vc", 10)
+    assert cache.get("a").value == "A"  # a is now the most recently used
+    cache.put("d", "D", "vd", 10)
+    assert cache.get("b") is None
+    assert [key for key in cache.entries] == ["c", "a", "d"]
+    assert cache.size == 30
+
+
+def test_result_cache_size_accounting():
+    cache = ResultCache(max_size=100, max_age=60, stale_time=10)
+    cache.put("a", "A", "va", 40)
+    cache.put("a", "A2", "va2", 20)  # Replacing an entry gives its size back
+    assert cache.size == 20
+    cache.put("huge", "H", "vh", 101)  # Too large to ever fit, and does not evict anything
+    assert cache.get("huge") is None
+    assert cache.get("a").value == "A2"
+    cache.remove("a")
+    assert cache.size == 0
+
+
+def test_result_cache_expiry_and_staleness():
+    cache = ResultCache(max_size=100, max_age=60, stale_time=10)
+    cache.put("a", "A", "va", 10)
+    entry = cache.get("a")
+    assert cache.can_serve_stale(entry)
+    entry.created -= 30  # Older than stale_time, but still within max_age
+    assert cache.get("a") is entry
+    assert not cache.can_serve_stale(entry)
+    entry.created -= 31  # Past max_age
+    assert cache.get("a") is None
+    assert "a" not in cache.entries
+    assert cache.size == 0
+
+
+def test_negative_cache():
+    cache = NegativeCache(max_entries=2, ttl=60)
+    cache.add("a")
+    cache.add("b")
+    assert "a" in cache
+    cache.add("c")  # Evicts the oldest entry
+    assert "a" not in cache
+    assert "b" in cache and "c" in cache
+    assert cache.hits == 3
+    cache.entries["c"] = 0  # Expired
+    assert "c" not in cache
+    assert "c" not in cache.entries
+    cache.discard("b")
+    assert "b" not in cache
+
+
+def test_negative_cache_disabled():
+    cache = NegativeCache(max_entries=10, ttl=0)
+    cache.add("a")
+    assert "a" not in cache
+    assert cache.stats() == {"entries": 0, "hits": 0}
+
+
+def test_session_cache_eviction():
+    cache = SessionCache(max_entries=2, max_age=100)
+    for cookie in ("a", "b", "c"):
+        cache[cookie] = make_session(cookie)
+    assert "a" not in cache
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    assert cache.lookup("b", 1050) is not None  # b is now the most recently used
+    cache["d"] = make_session("d")
+    assert "c" not in cache and "b" in cache
+
+
+def test_session_cache_expiry():
+    cache = SessionCache(max_entries=10, max_age=100)
+    cache["a"] = make_session("a", last_accessed=1000)
+    cache["b"] = make_session("b", last_accessed=1090)
+    assert cache.lookup("a", 1101) is None
+    assert "a" not in cache
+    assert cache.sweep(1191) == 1
+    assert len(cache) == 0
+    assert cache.expirations == 2
+
+
+def test_session_cache_keeps_evicted_dirty_sessions():
+    cache = SessionCache(max_entries=1, max_age=100)
+    cache["a"] = make_session("a")
+    cache.touch("a", 1010)
+    cache["b"] = make_session("b")  # Evicts a, whose last access has not been saved yet
+    cache.touch("b", 1020)
+    assert cache.stats()["unsaved"] == 2
+    dirty = cache.take_dirty()
+    assert sorted(session.cookie for session in dirty) == ["a", "b"]
+    assert cache.take_dirty() == []
+
+    # A failed save puts them back, the evicted one included
+    cache.requeue(dirty)
+    assert cache.dirty == {"b"}
+    assert list(cache.evicted_dirty) == ["a"]
+    del cache["b"]
+    assert sorted(session.cookie for session in cache.take_dirty()) == ["a"]
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# To be run as: python3 -m pytest test/test_compression.py
+# This ensures sys.path is set up correctly
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("aiohttp")  # Needs the server requirements
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from plugins import compression  # noqa: E402
+
+BEST = "br" if compression.brotli else "gzip"
+
+
+def test_negotiate_preference():
+    assert compression.negotiate("gzip, deflate, br") == BEST
+    assert compression.negotiate("br;q=1.0, gzip;q=0.8") == BEST
+    assert compression.negotiate("gzip") == "gzip"
+    assert compression.negotiate("GZip") == "gzip"
+
+
+def test_negotiate_nothing_acceptable():
+    assert compression.negotiate("") is None
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate("deflate, compress") is None
+    assert compression.negotiate("gzip;q=0, br;q=0") is None
+    assert compression.negotiate("gzip;q=nonsense") is None
+
+
+def test_negotiate_wildcard():
+    assert compression.negotiate("*") == BEST
+    assert compression.negotiate("*;q=0") is None
+    assert compression.negotiate("br;q=0, *") == "gzip"
+    assert compression.negotiate("*, gzip;q=0") == ("br" if compression.brotli else None)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# To be run as: python3 -m pytest test/test_conditional.py
+# This ensures sys.path is set up correctly
+
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("aiohttp")  # Needs the server requirements
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from plugins.conditional import is_fresh  # noqa: E402
+
+ETAG = 'W/"0123456789abcdef"'
+
+
+def make_session(if_none_match=""):
+    return types.SimpleNamespace(response_headers={}, if_none_match=if_none_match)
+
+
+def test_sets_validators():
+    session = make_session()
+    assert not is_fresh(session, ETAG)
+    assert session.response_headers == {"ETag": ETAG, "Cache-Control": "private, no-cache"}
+
+
+def test_if_none_match():
+    assert is_fresh(make_session(if_none_match=ETAG), ETAG)
+    assert is_fresh(make_session(if_none_match='"0123456789abcdef"'), ETAG)  # Weak comparison
+    assert is_fresh(make_session(if_none_match='W/"other", W/"0123456789abcdef"'), ETAG)
+    assert is_fresh(make_session(if_none_match="*"), ETAG)
+    assert not is_fresh(make_session(if_none_match='W/"other"'), ETAG)
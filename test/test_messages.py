@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# To be run as: python3 -m pytest test/test_messages.py
+# This ensures sys.path is set up correctly
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("aiohttp")  # Needs the server requirements
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from plugins import messages  # noqa: E402
+
+LIST = "<dev.example.org>"
+
+
+def make_email(mid, epoch, subject, in_reply_to="", references="", sender="a@example.org"):
+    return {
+        "mid": mid,
+        "message-id": "<%s@example.org>" % mid,
+        "in-reply-to": in_reply_to and "<%s@example.org>" % in_reply_to,
+        "references": " ".join("<%s@example.org>" % ref for ref in references.split()),
+        "subject": subject,
+        "from": sender,
+        "epoch": epoch,
+        "list_raw": LIST,
+    }
+
+
+def node(mid, *children):
+    return {"mid": mid, "children": list(children)}
+
+
+def test_in_list_scope():
+    assert messages.in_list_scope({"term": {"list_raw": LIST}}, LIST)
+    assert not messages.in_list_scope({"term": {"list_raw": LIST}}, "<users.example.org>")
+    assert messages.in_list_scope({"wildcard": {"list_raw": {"value": "*.example.org>"}}}, LIST)
+    assert not messages.in_list_scope({"wildcard": {"list_raw": {"value": "*.example.com>"}}}, LIST)
+    assert messages.in_list_scope({"wildcard": {"list_raw": "<dev.*>"}}, LIST)
+    assert not messages.in_list_scope({"wildcard": {"list_raw": "<users.*>"}}, LIST)
+    assert messages.in_list_scope({"wildcard": {"list_raw": "*"}}, LIST)
+    # Anything else might match any list
+    assert messages.in_list_scope({"terms": {"list_raw": [LIST]}}, "<users.example.org>")
+    assert messages.in_list_scope({"match_all": {}}, LIST)
+
+
+def test_find_siblings():
+    root_children = []
+    reply_children = []
+    placed = {"<root@example.org>": root_children, "<reply@example.org>": reply_children}
+    assert messages.find_siblings(make_email("x", 1, "", in_reply_to="reply"), placed) is reply_children
+    # The closest placed reference wins if the in-reply-to is unknown
+    doc = make_email("x", 1, "", in_reply_to="unknown", references="root reply unknown")
+    assert messages.find_siblings(doc, placed) is reply_children
+    doc = make_email("x", 1, "", references="root other")
+    assert messages.find_siblings(doc, placed) is root_children
+    # Mangled headers still match on the message-id
+    doc = make_email("x", 1, "")
+    doc["in-reply-to"] = "Your message of ... <root@example.org> (foo)"
+    assert messages.find_siblings(doc, placed) is root_children
+    assert messages.find_siblings(make_email("x", 1, "", in_reply_to="unknown"), placed) is None
+
+
+def test_place_replies():
+    root = make_email("root", 1, "Hi")
+    root["children"] = []
+    placed = {root["message-id"]: root["children"]}
+    pdocs = {"root": root}
+    docs = [
+        make_email("r2", 3, "Re: Hi", in_reply_to="r1"),  # Comes in before its parent, but is newer
+        make_email("r1", 2, "Re: Hi", in_reply_to="root"),
+        make_email("orphan", 4, "Re: ?", in_reply_to="unknown"),
+        make_email("root", 1, "Hi"),  # Already placed
+    ]
+    new_ids = messages.place_replies(docs, placed, pdocs, short=True)
+    assert new_ids == ["<r1@example.org>", "<r2@example.org>"]
+    assert sorted(pdocs) == ["r1", "r2", "root"]
+    assert [child["mid"] for child in root["children"]] == ["r1"]
+    assert [child["mid"] for child in root["children"][0]["children"]] == ["r2"]
+    assert root["children"][0]["irt"] == "<root@example.org>"
+    # Placing them again changes nothing
+    assert messages.place_replies(docs, placed, pdocs, short=True) == []
+    assert len(root["children"]) == 1
+
+
+def test_project_thread_summaries_matches_thread_constructor():
+    emails = [
+        make_email("a", 1, "Release 1.0", sender="a@example.org"),
+        make_email("b", 2, "Re: Release 1.0", in_reply_to="a", sender="b@example.org"),
+        make_email("c", 3, "Other topic", sender="c@example.org"),
+        make_email("d", 4, "RE: Release 1.0", in_reply_to="a", sender="b@example.org"),
+        make_email("e", 5, "Re: Other topic", in_reply_to="c", sender="a@example.org"),
+    ]
+    summaries = [
+        {"list_raw": LIST, "tree": node("a", node("b"), node("d"))},
+        {"list_raw": LIST, "tree": node("c", node("e"))},
+    ]
+    expected = messages.ThreadConstructor(emails).construct()
+    assert messages.project_thread_summaries(summaries, emails) == expected
+
+
+def test_project_thread_summaries_partial_results():
+    emails = [
+        make_email("a", 1, "Release 1.0"),
+        make_email("c", 3, "Re: Release 1.0", in_reply_to="b"),
+    ]
+    emails[1]["subject"] = "Re: Release 1.0 (edited)"  # Subjects come from the emails, not the summaries
+    summaries = [{"list_raw": LIST, "tree": node("a", node("b", node("c")))}]
+    threads, authors = messages.project_thread_summaries(summaries, emails)
+    # b is not in the results, so its reply moves up to a
+    assert len(threads) == 1
+    assert [child["tid"] for child in threads[0]["children"]] == ["c"]
+    assert threads[0]["children"][0]["nest"] == 2
+    assert threads[0]["children"][0]["subject"] == "Re: Release 1.0 (edited)"
+    assert authors == {"a@example.org": [2, ""]}
+
+
+def test_project_thread_summaries_missing_emails():
+    emails = [make_email("a", 1, "Release 1.0"), make_email("x", 2, "Not summarised yet")]
+    summaries = [{"list_raw": LIST, "tree": node("a")}]
+    assert messages.project_thread_summaries(summaries, emails) is None
+
+
+def test_project_thread_summaries_follows_reply_headers():
+    # Summaries group emails by their reply headers, ThreadConstructor by subject
+    emails = [
+        make_email("a", 1, "Weekly report"),
+        make_email("b", 2, "Spin-off topic (was: Weekly report)", in_reply_to="a"),
+        make_email("c", 3, "Weekly report"),  # A new thread that happens to have the same subject
+    ]
+    summaries = [
+        {"list_raw": LIST, "tree": node("a", node("b"))},
+        {"list_raw": LIST, "tree": node("c")},
+    ]
+    threads, _authors = messages.project_thread_summaries(summaries, emails)
+    assert [(thread["tid"], [child["tid"] for child in thread["children"]]) for thread in threads] == [
+        ("a", ["b"]),
+        ("c", []),
+    ]
+    threads, _authors = messages.ThreadConstructor(emails).construct()
+    assert [(thread["tid"], [child["tid"] for child in thread["children"]]) for thread in threads] == [
+        ("a", ["c"]),
+        ("b", []),
+    ]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_textlib.py
+# This ensures sys.path is set up correctly
+
+import ast
+import email.utils
+import os
+import re
+
+import pytest
+
+from tools.plugins import textlib
+
+SERVER_MESSAGES = os.path.join(os.path.dirname(__file__), "..", "server", "plugins", "messages.py")
+SERVER_NAMES = ("NEEDS_QUOTES", "ESCAPES_RE", "ANONYMIZE_ADDRESS_RE", "make_address", "anonymize_mail_address")
+
+ADDRESSES = [
+    "",
+    "john@example.org",
+    "John Doe <john.doe@example.org>",
+    "Doe, John <jd@example.org>",
+    '"Doe, John" <jd@sub.example.org>',
+    'Jo "JD" Doe <j@example.org>',
+    "Back\\slash <bs@example.org>",
+    "Ünicode Nåme <u@example.org>",
+    "a@example.org, B <bee@example.org>, \"C, D\" <cd@example.org>",
+    "not an address",
+]
+
+
+def server_namespace() -> dict:
+    """Loads the address anonymisation of the API server, without the dependencies of its module"""
+    with open(SERVER_MESSAGES, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    nodes = [
+        node
+        for node in tree.body
+        if (isinstance(node, ast.FunctionDef) and node.name in SERVER_NAMES)
+        or (isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) in SERVER_NAMES)
+    ]
+    namespace = {"re": re, "email": email}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), SERVER_MESSAGES, "exec"), namespace)
+    assert all(name in namespace for name in SERVER_NAMES)
+    return namespace
+
+
+@pytest.mark.parametrize("address", ADDRESSES)
+def test_anonymize_mail_address_same_as_server(address):
+    server = server_namespace()
+    assert textlib.anonymize_mail_address(address) == server["anonymize_mail_address"](address)
+
+
+def test_anonymized_fields():
+    doc = {"from": "John Doe <john@example.org>", "to": "dev@example.org", "cc": "", "subject": "Hi"}
+    assert textlib.anonymized_fields(doc) == {
+        "from": ["John Doe <john@example.org>", "John Doe <jo...@example.org>"],
+        "to": ["dev@example.org", "de...@example.org"],
+    }
+    assert textlib.anonymized_fields({"subject": "Hi"}) == {}
+
+
+def test_regexes_same_as_server():
+    server = server_namespace()
+    for name in ("NEEDS_QUOTES", "ESCAPES_RE", "ANONYMIZE_ADDRESS_RE"):
+        assert getattr(textlib, name).pattern == server[name].pattern
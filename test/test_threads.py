@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# To be run as: python3 -m pytest test/test_threads.py
+# This ensures sys.path is set up correctly
+
+from tools.plugins import threads
+
+
+def make_doc(mid, epoch, in_reply_to="", references="", sender="a@example.org"):
+    return {
+        "mid": mid,
+        "message-id": "<%s@example.org>" % mid,
+        "in-reply-to": in_reply_to and "<%s@example.org>" % in_reply_to,
+        "references": " ".join("<%s@example.org>" % ref for ref in references.split()),
+        "subject": "Re: Hi" if in_reply_to else "Hi",
+        "from": sender,
+        "epoch": epoch,
+        "list_raw": "<dev.example.org>",
+    }
+
+
+def test_add_to_summary():
+    summary = threads.new_summary(make_doc("root", 10))
+    assert threads.add_to_summary(summary, make_doc("r1", 20, "root", sender="b@example.org"))
+    assert threads.add_to_summary(summary, make_doc("r2", 30, "r1", "root r1"))
+    assert threads.add_to_summary(summary, make_doc("early", 5, "root"))
+    assert not threads.add_to_summary(summary, make_doc("r1", 20, "root"))  # Already there
+    assert summary["replies"] == 3
+    assert summary["mids"] == ["root", "r1", "r2", "early"]
+    assert summary["message_ids"] == ["<%s@example.org>" % mid for mid in ("root", "r1", "r2", "early")]
+    assert summary["participants"] == ["a@example.org", "b@example.org"]
+    assert (summary["first_epoch"], summary["last_epoch"]) == (5, 30)
+    tree = summary["tree"]
+    assert [child["mid"] for child in tree["children"]] == ["early", "r1"]  # Oldest first
+    assert [child["mid"] for child in tree["children"][1]["children"]] == ["r2"]
+
+
+def test_add_to_summary_closest_ancestor():
+    summary = threads.new_summary(make_doc("root", 10))
+    nodes = threads.index_nodes(summary)
+    mids = set(summary["mids"])
+    threads.add_to_summary(summary, make_doc("r1", 20, "root"), nodes, mids)
+    # Its parent was never archived, so it goes under the closest known reference
+    threads.add_to_summary(summary, make_doc("r3", 30, "r2", "root r1 r2"), nodes, mids)
+    # Without any known parent, it goes under the root
+    threads.add_to_summary(summary, make_doc("x", 40, "unknown"), nodes, mids)
+    tree = summary["tree"]
+    assert [child["mid"] for child in tree["children"]] == ["r1", "x"]
+    assert [child["mid"] for child in tree["children"][0]["children"]] == ["r3"]
+    assert mids == {"root", "r1", "r3", "x"}
+
+
+def test_add_to_summary_truncates(monkeypatch):
+    monkeypatch.setattr(threads, "SUMMARY_MAX_EMAILS", 3)
+    summary = threads.new_summary(make_doc("root", 10))
+    assert threads.add_to_summary(summary, make_doc("r1", 20, "root"))
+    assert threads.add_to_summary(summary, make_doc("r2", 30, "root"))
+    assert not summary["truncated"]
+    # The first reply that does not fit marks the summary, so it is stored once more
+    assert threads.add_to_summary(summary, make_doc("r3", 40, "root"))
+    assert summary["truncated"]
+    assert not threads.add_to_summary(summary, make_doc("r4", 50, "root"))
+    assert summary["mids"] == ["root", "r1", "r2"]
+    assert summary["replies"] == 2
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    anonymize-addresses.py: anonymised address field backfill for Apache Pony Mail (Foal)
+
+    Stores the anonymised from/to/cc fields (_anonymized) of existing emails, adding the
+    field to the mbox mapping first if need be. archiver.py and import-mbox.py store the
+    field for new emails once the mapping has it. The API server works the anonymised
+    values out itself for emails without the field, or whose headers have been edited
+    since it was stored, so this can be run at any time, and re-run after bulk edits.
+
+    Examples:
+        - Add the anonymised fields of all emails:
+            python3 anonymize-addresses.py
+        - Only those of <dev.maven.apache.org>:
+            python3 anonymize-addresses.py --list "<dev.maven.apache.org>"
+"""
+
+import argparse
+
+from elasticsearch.helpers import scan
+
+if not __package__:
+    from plugins import textlib # pylint: disable=no-name-in-module
+    from plugins.elastic import Elastic # pylint: disable=no-name-in-module
+else:
+    from .plugins import textlib # pylint: disable=no-name-in-module
+    from .plugins.elastic import Elastic # pylint: disable=no-name-in-module
+
+ANONYMIZED_MAPPING = {"type": "object", "enabled": False}  # Must be the same as mappings.yaml
+
+
+def gen_args() -> argparse.Namespace:
+    """Generate/parse CLI arguments"""
+    parser = argparse.ArgumentParser(description="Command line options.")
+    parser.add_argument(
+        "--list",
+        dest="lists",
+        action="append",
+        help="List to add the anonymised fields of, e.g. '<dev.maven.apache.org>'. May be repeated. Default: all lists",
+    )
+    parser.add_argument(
+        "--test",
+        dest="test",
+        action="store_true",
+        help="Test mode, only count the emails needing the fields, but do not change the mapping or store them.",
+    )
+    return parser.parse_args()
+
+
+def outdated(elastic: Elastic, lists=None):
+    """Yields the id and anonymised fields of each email whose _anonymized field is missing or stale"""
+    query: dict = {"match_all": {}}
+    if lists:
+        query = {"terms": {"list_raw": lists}}
+    for hit in scan(
+        client=elastic.es,
+        index=elastic.db_mbox,
+        query={"query": query, "_source": list(textlib.ANONYMIZED_FIELDS) + ["_anonymized"]},
+    ):
+        fields = textlib.anonymized_fields(hit["_source"])
+        if fields != hit["_source"].get("_anonymized"):
+            yield hit["_id"], fields
+
+
+def main():
+    args = gen_args()
+    elastic = Elastic()
+
+    if not args.test:
+        mapping = elastic.indices.get_mapping(index=elastic.db_mbox)
+        if not all("_anonymized" in index["mappings"].get("properties", {}) for index in mapping.values()):
+            print("Adding the _anonymized field to the mapping of %s" % elastic.db_mbox)
+            elastic.indices.put_mapping(
+                index=elastic.db_mbox, body={"properties": {"_anonymized": ANONYMIZED_MAPPING}}
+            )
+
+    count = 0
+    actions = []
+    for mid, fields in outdated(elastic, args.lists):
+        count += 1
+        if args.test:
+            continue
+        actions.append({"_op_type": "update", "_index": elastic.db_mbox, "_id": mid, "doc": {"_anonymized": fields}})
+        if len(actions) >= 500:
+            elastic.bulk(actions)
+            actions = []
+    if actions:
+        elastic.bulk(actions)
+    print("%u emails %s" % (count, "need their anonymised fields (re)computed" if args.test else "updated"))
+
+
+if __name__ == "__main__":
+    main()
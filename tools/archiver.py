@@ -63,11 +63,11 @@ import netaddr
 
 if not __package__:
     from plugins import ponymailconfig # pylint: disable=no-name-in-module
-    from plugins import generators, textlib # pylint: disable=no-name-in-module
+    from plugins import generators, textlib, threads # pylint: disable=no-name-in-module
     from plugins.elastic import Elastic # pylint: disable=no-name-in-module
 else:
     from .plugins import ponymailconfig # pylint: disable=no-name-in-module
-    from .plugins import generators, textlib # pylint: disable=no-name-in-module
+    from .plugins import generators, textlib, threads # pylint: disable=no-name-in-module
     from .plugins.elastic import Elastic # pylint: disable=no-name-in-module
 
 # This is what we will default to if we are presented with emails without character sets and US-ASCII doesn't work.
@@ -313,6 +313,13 @@ def get_by_message_id(elastic, msgid, timeout="5s"):
     return None
 
 
+def anonymized_fields_mapped(elastic):
+    """Whether the mbox mapping has the _anonymized field. Its mapping is strict, so
+    older indices need the field added (anonymize-addresses.py does so) before it is stored."""
+    mapping = elastic.indices.get_mapping(index=elastic.db_mbox)
+    return any("_anonymized" in index["mappings"].get("properties", {}) for index in mapping.values())
+
+
 def get_parent_info(elastic, ojson, timeout=5, limit=10):
     parent_identifiers = get_parent_identifiers(ojson)
     if not parent_identifiers:
@@ -400,6 +407,8 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
         self.cropout = config.get("debug", "cropout")
         self.verbose = verbose
         self.ignore_body = ignore_body
+        # Whether the mbox mapping has the _anonymized field, checked on the first message archived
+        self.anonymized_mapped: typing.Optional[bool] = None
         if self.html:
             import html2text
 
@@ -725,6 +734,17 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
                 if logger:
                     logger.info("Added thread info successfully %s", ojson["mid"])
 
+        # Store the anonymised address fields, so they need not be worked out for each anonymous visitor
+        try:
+            if self.anonymized_mapped is None:
+                self.anonymized_mapped = anonymized_fields_mapped(elastic)
+            if self.anonymized_mapped:
+                ojson["_anonymized"] = textlib.anonymized_fields(ojson)
+        except Exception as err:
+            print("Could not add anonymised address fields", err)
+            if logger:
+                logger.info("Could not add anonymised address fields %s", err)
+
         try:
             if contents:
                 for key in contents:
@@ -796,6 +816,15 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
             # otherwise fail as before
             raise err
 
+        # Add the email to its thread summary, if the threads index has been set up
+        try:
+            if elastic.indices.exists(index=elastic.db_threads):
+                threads.update_thread_summary(elastic, ojson)
+        except Exception as err:
+            print("Could not update thread summary", err)
+            if logger:
+                logger.info("Could not update thread summary %s", err)
+
         if logger:
             logger.info("Pony Mail archived message %s successfully", ojson["mid"])
         oldrefs = []
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    build-thread-index.py: thread summary (re)builder for Apache Pony Mail (Foal)
+
+    Builds the thread summaries of existing archives, one list at a time, replacing
+    any summaries already there. archiver.py and import-mbox.py keep the summaries
+    up to date once the threads index exists; run this after creating the index
+    (mappings.py --create --shards 1 --replicas 1 threads), and again for any list
+    whose replies were imported before the emails they reply to, or whose emails have
+    been moved to another list or deleted through the admin UI, as those changes are
+    not carried over to the summaries.
+
+    A list's summaries are deleted before its new ones are stored, so list views of it
+    thread their emails on request in the meantime, and emails archived to the list
+    while it is being rebuilt may be missing from its summaries. Stop archiving to the
+    lists being rebuilt while this runs, or run it again for them afterwards.
+
+    Examples:
+        - Build the summaries of all lists:
+            python3 build-thread-index.py
+        - Rebuild the summaries of <dev.maven.apache.org> only:
+            python3 build-thread-index.py --list "<dev.maven.apache.org>"
+"""
+
+import argparse
+import sys
+import typing
+
+from elasticsearch.helpers import scan
+
+if not __package__:
+    from plugins import threads # pylint: disable=no-name-in-module
+    from plugins.elastic import Elastic # pylint: disable=no-name-in-module
+else:
+    from .plugins import threads # pylint: disable=no-name-in-module
+    from .plugins.elastic import Elastic # pylint: disable=no-name-in-module
+
+MAX_LISTS = 65535  # Maximum number of lists to fetch when building all of them
+SOURCE_FIELDS = ["mid", "message-id", "in-reply-to", "references", "subject", "from", "epoch", "list_raw", "private"]
+
+
+def gen_args() -> argparse.Namespace:
+    """Generate/parse CLI arguments"""
+    parser = argparse.ArgumentParser(description="Command line options.")
+    parser.add_argument(
+        "--list",
+        dest="lists",
+        action="append",
+        help="List to build the thread summaries of, e.g. '<dev.maven.apache.org>'. May be repeated. Default: all lists",
+    )
+    parser.add_argument(
+        "--test",
+        dest="test",
+        action="store_true",
+        help="Test mode, only build and count the summaries, but do not store them.",
+    )
+    return parser.parse_args()
+
+
+def all_lists(elastic: Elastic) -> typing.List[str]:
+    res = elastic.search(
+        index=elastic.db_mbox,
+        body={"size": 0, "aggs": {"lists": {"terms": {"field": "list_raw", "size": MAX_LISTS}}}},
+    )
+    return sorted(bucket["key"] for bucket in res["aggregations"]["lists"]["buckets"])
+
+
+def build_summaries(elastic: Elastic, list_raw: str) -> typing.List[dict]:
+    """Builds the thread summaries of a list, threading its emails oldest first"""
+    docs = [
+        hit["_source"]
+        for hit in scan(
+            client=elastic.es,
+            index=elastic.db_mbox,
+            query={
+                "query": {
+                    "bool": {
+                        "must": [{"term": {"list_raw": list_raw}}],
+                        "must_not": [{"term": {"deleted": True}}],
+                    }
+                },
+                "_source": SOURCE_FIELDS,
+            },
+        )
+    ]
+    docs.sort(key=lambda doc: doc.get("epoch", 0))
+
+    summaries: typing.List[dict] = []
+    # message-id -> (summary, nodes, mids)
+    by_message_id: typing.Dict[str, typing.Tuple[dict, dict, typing.Set[str]]] = {}
+    for doc in docs:
+        for identifier in threads.parent_identifiers(doc):
+            if identifier in by_message_id:
+                summary, nodes, mids = by_message_id[identifier]
+                threads.add_to_summary(summary, doc, nodes, mids)
+                break
+        else:
+            summary = threads.new_summary(doc)
+            nodes = threads.index_nodes(summary)
+            mids = set(summary["mids"])
+            summaries.append(summary)
+        if doc.get("message-id"):
+            by_message_id.setdefault(doc["message-id"], (summary, nodes, mids))
+    return summaries
+
+
+def main():
+    args = gen_args()
+    elastic = Elastic()
+    if not elastic.indices.exists(index=elastic.db_threads):
+        print("Error: the index '%s' does not exist! Create it with mappings.py first." % elastic.db_threads)
+        sys.exit(1)
+
+    if not args.test:
+        print("Warning: stop archiving to the lists being rebuilt until this has finished, or rebuild them again afterwards")
+    lists = args.lists or all_lists(elastic)
+    for list_raw in lists:
+        summaries = build_summaries(elastic, list_raw)
+        emails = sum(summary["replies"] + 1 for summary in summaries)
+        print("%s: %u emails in %u threads" % (list_raw, emails, len(summaries)))
+        if args.test:
+            continue
+        elastic.es.delete_by_query(
+            index=elastic.db_threads,
+            body={"query": {"term": {"list_raw": list_raw}}},
+            refresh=True,
+        )
+        elastic.bulk(
+            {"_op_type": "index", "_index": elastic.db_threads, "_id": summary["root"], "_source": summary}
+            for summary in summaries
+        )
+
+
+if __name__ == "__main__":
+    main()
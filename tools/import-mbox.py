@@ -40,10 +40,12 @@ if not __package__:
     import archiver
     from plugins import textlib
     from plugins.elastic import Elastic
+    from plugins.threads import update_thread_summary
 else:
     from . import archiver
     from .plugins.elastic import Elastic
     from .plugins import textlib
+    from .plugins.threads import update_thread_summary
 
 TIMEOUT_DEFAULT = 600
 goodies = 0
@@ -62,6 +64,8 @@ start = time.time()
 quickmode = False
 private = False
 appender = "apache.org"
+thread_index = False # Whether to maintain thread summaries
+anonymized_fields = False # Whether to store the anonymised address fields
 
 
 source = "./"
@@ -141,6 +145,16 @@ def bulk_insert_both(name, mbox, source, xes):
     replacements += repl
     goodies -= failures
     dupes += failures
+    if thread_index:
+        update_thread_summaries(name, [mbox[i] for i in successes], xes)
+
+def update_thread_summaries(name, mbox, xes):
+    """Add newly created mbox entries to their thread summaries"""
+    for doc in mbox:
+        try:
+            update_thread_summary(xes, doc)
+        except Exception as err:
+            print("%s: Warning: Could not update thread summary for %s: %s" % (name, doc["mid"], err))
 
 class DownloadThread(Thread): # handles Pipermail
     def assign(self, url):
@@ -420,6 +434,8 @@ class SlurpThread(Thread):
                             JSON.dump(json, dumpfile, indent=2, sort_keys=True, ensure_ascii=False)
                             dumpfile.write(",\n")
                         continue
+                    if anonymized_fields:
+                        json["_anonymized"] = textlib.anonymized_fields(json)
                     ja.append(json)
                     jas.append(json_source)
                     if contents:
@@ -712,6 +728,18 @@ else:
         print("Error: unable to check if the index %s exists!: %s" % (es.db_mbox, err))
         sys.exit(1)
 
+    # Thread summaries are only kept if their index has been set up
+    try:
+        thread_index = es.indices.exists(index=es.db_threads)
+    except Exception as err:
+        print("Warning: unable to check if the index %s exists, not updating thread summaries: %s" % (es.db_threads, err))
+
+    # Anonymised address fields are only stored if the mbox mapping has room for them
+    try:
+        anonymized_fields = archiver.anonymized_fields_mapped(es)
+    except Exception as err:
+        print("Warning: unable to check the mapping of %s, not storing anonymised address fields: %s" % (es.db_mbox, err))
+
 def glob_dir(d):
     dirs = [f for f in listdir(d) if isdir(join(d, f))]
     mboxes = [f for f in glob.glob(join(d, "*" + extension)) if isfile(f)]
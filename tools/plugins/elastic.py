@@ -44,6 +44,7 @@ class Elastic:
     db_session:         str
     db_notification:    str
     db_auditlog:        str
+    db_threads:         str
     dbname:             str
 
     def __init__(self, logger_level=None, trace_level=None, is_async=False):
@@ -60,6 +61,7 @@ class Elastic:
         self.db_session = dbname + '-session'
         self.db_notification = dbname + '-notification'
         self.db_auditlog = dbname + '-auditlog'
+        self.db_threads = dbname + '-threads'
         self.db_version = 0
         self.is_async = is_async
 
@@ -17,9 +17,17 @@
 
 """Auxiliary text modding library for Apache Pony Mail (Foal)"""
 
+import email.utils
 import re
 import typing
 
+# These must be the same as server/plugins/messages.py
+NEEDS_QUOTES = re.compile(r'[][\\()<>@,:;".]')  # If these characters are present in an email display name, quote it
+ESCAPES_RE = re.compile(r'[\\"]')  # Characters to escape with backslash in make_address()
+ANONYMIZE_ADDRESS_RE = re.compile(r"(\S{1,2})\S*@([-a-zA-Z0-9_.]+)")
+ANONYMIZED_FIELDS = ("from", "to", "cc")
+
+
 def normalize_lid(lid: str, strict: bool = False) -> typing.Optional[str]:
     """ Ensures that a List ID is in standard form, i.e. <a.b.c.d> """
     # If of format "list name" <foo.bar.baz>
@@ -40,3 +48,38 @@ def normalize_lid(lid: str, strict: bool = False) -> typing.Optional[str]:
         print("Invalid list-id %s" % lid)
         return None
     return lid
+
+
+# Format an email address given a name (optional) and an email address.
+# Same as email.utils.formataddr except no Unicode escaping happens.
+def make_address(name: str, mailaddress: str) -> str:
+    if name and mailaddress:
+        quotes = ''
+        if NEEDS_QUOTES.search(name):
+            quotes = '"'
+        name = ESCAPES_RE.sub(r'\\\g<0>', name)
+        return f'{quotes}{name}{quotes} <{mailaddress}>'
+    elif mailaddress:
+        return mailaddress
+    else:
+        return ""
+
+
+def anonymize_mail_address(emailstring: str) -> str:
+    """ Anonymises a string of email entries, as the API server does for anonymous visitors """
+    out = []
+    if not emailstring:
+        return ""
+    for real, addr in email.utils.getaddresses([emailstring]):
+        out.append(make_address(real, ANONYMIZE_ADDRESS_RE.sub("\\1...@\\2", addr)))
+    return ",\n ".join(out)
+
+
+def anonymized_fields(doc: dict) -> typing.Dict[str, typing.List[str]]:
+    """ Returns the _anonymized field of an mbox document: the address headers it has,
+    each as [value, anonymised value], so that edited headers are not served stale """
+    return {
+        header: [doc[header], anonymize_mail_address(doc[header])]
+        for header in ANONYMIZED_FIELDS
+        if doc.get(header)
+    }
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Thread summary library for Apache Pony Mail (Foal)
+
+A thread summary holds the root, reply tree, participants and date span of a
+thread, so that list views need not re-thread every email on each request.
+Summaries are kept up to date by archiver.py and import-mbox.py when the
+threads index exists, and can be (re)built with build-thread-index.py.
+"""
+
+import re
+import typing
+
+from elasticsearch.exceptions import ConflictError
+
+SUMMARY_RETRIES = 5  # Attempts at updating a summary that is being changed concurrently
+SUMMARY_MAX_EMAILS = 1000  # Threads longer than this are marked truncated, and threaded on request instead
+
+MESSAGE_ID_RE = re.compile(r"<[^<>]+>")
+
+
+def parent_identifiers(doc: dict) -> typing.List[str]:
+    """Returns the message-ids an email replies to, closest ancestor first"""
+    identifiers = list(reversed(MESSAGE_ID_RE.findall(doc.get("in-reply-to") or "")))
+    identifiers.extend(reversed(MESSAGE_ID_RE.findall(doc.get("references") or "")))
+    return identifiers
+
+
+def new_node(doc: dict) -> dict:
+    return {
+        "mid": doc["mid"],
+        "message-id": doc.get("message-id", ""),
+        "subject": doc.get("subject", ""),
+        "from": doc.get("from", ""),
+        "epoch": doc.get("epoch", 0),
+        "children": [],
+    }
+
+
+def new_summary(doc: dict) -> dict:
+    """Returns the summary of a thread started by an email"""
+    return {
+        "root": doc["mid"],
+        "message-id": doc.get("message-id", ""),
+        "subject": doc.get("subject", ""),
+        "list_raw": doc.get("list_raw", ""),
+        "private": bool(doc.get("private", False)),
+        "first_epoch": doc.get("epoch", 0),
+        "last_epoch": doc.get("epoch", 0),
+        "replies": 0,
+        "truncated": False,
+        "participants": [doc.get("from", "")],
+        "mids": [doc["mid"]],
+        "message_ids": [doc["message-id"]] if doc.get("message-id") else [],
+        "tree": new_node(doc),
+    }
+
+
+def index_nodes(summary: dict) -> typing.Dict[str, dict]:
+    """Returns the nodes of a summary's tree by message-id"""
+    nodes: typing.Dict[str, dict] = {}
+    todo = [summary["tree"]]
+    while todo:
+        node = todo.pop()
+        if node["message-id"]:
+            nodes.setdefault(node["message-id"], node)
+        todo.extend(node["children"])
+    return nodes
+
+
+def add_to_summary(
+    summary: dict,
+    doc: dict,
+    nodes: typing.Optional[typing.Dict[str, dict]] = None,
+    mids: typing.Optional[typing.Set[str]] = None,
+) -> bool:
+    """Adds a reply to a thread summary, under its closest known ancestor.
+    nodes (see index_nodes) and mids (the set of summary["mids"]) can be kept by callers adding many replies.
+    Returns False if the email was already part of the thread, or the thread was already too long to summarise."""
+    if mids is None:
+        mids = set(summary["mids"])
+    if doc["mid"] in mids or summary.get("truncated"):
+        return False
+    if len(mids) >= SUMMARY_MAX_EMAILS:
+        summary["truncated"] = True
+        return True
+    if nodes is None:
+        nodes = index_nodes(summary)
+    parent = summary["tree"]
+    for identifier in parent_identifiers(doc):
+        if identifier in nodes:
+            parent = nodes[identifier]
+            break
+    node = new_node(doc)
+    parent["children"].append(node)
+    parent["children"].sort(key=lambda child: child["epoch"])
+    if node["message-id"]:
+        nodes.setdefault(node["message-id"], node)
+        summary["message_ids"].append(node["message-id"])
+    summary["mids"].append(node["mid"])
+    mids.add(node["mid"])
+    summary["replies"] += 1
+    summary["first_epoch"] = min(summary["first_epoch"], node["epoch"])
+    summary["last_epoch"] = max(summary["last_epoch"], node["epoch"])
+    if node["from"] not in summary["participants"]:
+        summary["participants"].append(node["from"])
+    summary["private"] = summary["private"] or bool(doc.get("private", False))
+    return True
+
+
+def find_summary(elastic, doc: dict) -> typing.Optional[dict]:
+    """Returns the search hit of the summary of the thread an email replies to, if any"""
+    identifiers = parent_identifiers(doc)
+    if not identifiers:
+        return None
+    res = elastic.search(
+        index=elastic.db_threads,
+        body={
+            "query": {
+                "bool": {
+                    "must": [
+                        {"terms": {"message_ids": identifiers}},
+                        {"term": {"list_raw": doc.get("list_raw", "")}},
+                    ]
+                }
+            },
+            "sort": [{"last_epoch": "desc"}],
+            "size": 1,
+            "seq_no_primary_term": True,
+        },
+    )
+    hits = res["hits"]["hits"]
+    return hits[0] if hits else None
+
+
+def update_thread_summary(elastic, doc: dict) -> None:
+    """Adds a newly archived email to the summary of its thread, or starts a new summary.
+    Replies archived before their parent start a summary of their own, until the index is rebuilt."""
+    thread_id = ""
+    for _attempt in range(SUMMARY_RETRIES):
+        hit = find_summary(elastic, doc)
+        if hit is None:
+            try:
+                elastic.create(index=elastic.db_threads, id=doc["mid"], body=new_summary(doc))
+            except ConflictError:
+                pass  # Re-archived thread starter, its summary is already there
+            return
+        thread_id = hit["_id"]
+        summary = hit["_source"]
+        if not add_to_summary(summary, doc):
+            return
+        try:
+            elastic.index(
+                index=elastic.db_threads,
+                id=thread_id,
+                body=summary,
+                if_seq_no=hit["_seq_no"],
+                if_primary_term=hit["_primary_term"],
+            )
+            return
+        except ConflictError:
+            continue  # Another email was added to the thread in the meantime, try again
+    raise ValueError("Could not update the summary of thread %s for %s" % (thread_id, doc["mid"]))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Utility for aggregating the slow query log of the API server.
+Calls are grouped by query shape (the query body with all values blanked out),
+or by the lists they query, and the groups are listed by total time spent.
+
+Example: tools/slow-queries.py /var/log/ponymail/slow-queries.log*
+"""
+
+import argparse
+import json
+import typing
+
+
+def shape(body: typing.Any) -> typing.Any:
+    """Returns the structure of a query body, with all values replaced by '?'"""
+    if isinstance(body, dict):
+        return {key: shape(value) for key, value in body.items()}
+    if isinstance(body, list):
+        # Keep each distinct element shape once, so term lists of any length look the same
+        shapes = []
+        for item in body:
+            item_shape = shape(item)
+            if item_shape not in shapes:
+                shapes.append(item_shape)
+        return shapes
+    return "?"
+
+
+def lists(body: typing.Any) -> typing.Set[str]:
+    """Returns the list_raw values a query body filters on"""
+    found: typing.Set[str] = set()
+    if isinstance(body, dict):
+        for key, value in body.items():
+            if key == "list_raw":
+                if isinstance(value, dict):  # e.g. {"value": ...} or {"query": ...}
+                    value = value.get("value", value.get("query", ""))
+                if isinstance(value, list):
+                    found.update(str(v) for v in value)
+                else:
+                    found.add(str(value))
+            else:
+                found.update(lists(value))
+    elif isinstance(body, list):
+        for item in body:
+            found.update(lists(item))
+    return found
+
+
+def percentile(values: typing.List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command line options.")
+    parser.add_argument("logs", nargs="+", help="Slow query log file(s) to read, including rotated ones")
+    parser.add_argument(
+        "--by", choices=("shape", "list", "endpoint"), default="shape", help="What to group calls by (default: shape)"
+    )
+    parser.add_argument("--top", type=int, default=20, help="Number of groups to show (default: 20)")
+    args = parser.parse_args()
+
+    groups: typing.Dict[str, dict] = {}
+    for path in args.logs:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if args.by == "shape":
+                    keys = [
+                        "%s %s %s"
+                        % (entry.get("operation"), entry.get("index"), json.dumps(shape(entry.get("body")), sort_keys=True))
+                    ]
+                elif args.by == "list":
+                    keys = sorted(lists(entry.get("body"))) or ["(no list filter)"]
+                else:
+                    keys = [str(entry.get("endpoint"))]
+                for key in keys:
+                    group = groups.setdefault(
+                        key, {"wall_times": [], "took": 0.0, "hits": 0, "failed": 0, "endpoints": set(), "example": None}
+                    )
+                    group["wall_times"].append(entry.get("wall_time", 0.0))
+                    group["took"] += entry.get("took", 0.0)
+                    group["hits"] += entry.get("hits") or 0
+                    group["failed"] += 1 if entry.get("failed") else 0
+                    group["endpoints"].add(str(entry.get("endpoint")))
+                    if group["example"] is None or entry.get("wall_time", 0.0) > max(group["wall_times"][:-1]):
+                        group["example"] = entry.get("body")
+
+    ranked = sorted(groups.items(), key=lambda item: sum(item[1]["wall_times"]), reverse=True)
+    for key, group in ranked[: args.top]:
+        wall_times = group["wall_times"]
+        count = len(wall_times)
+        print(key)
+        print(
+            "  calls: %u, total: %.2fs, mean: %.3fs, p95: %.3fs, max: %.3fs, mean took: %.3fs, mean hits: %u, failed: %u"
+            % (
+                count,
+                sum(wall_times),
+                sum(wall_times) / count,
+                percentile(wall_times, 95),
+                max(wall_times),
+                group["took"] / count,
+                group["hits"] / count,
+                group["failed"],
+            )
+        )
+        print("  endpoints: %s" % ", ".join(sorted(group["endpoints"])))
+        if args.by != "shape":
+            print("  slowest query: %s" % json.dumps(group["example"]))
+        print()
+
+
+if __name__ == "__main__":
+    main()